@@ -1,18 +1,47 @@
 from flask import (Flask, render_template, request, redirect, url_for, flash,
-                   jsonify, g, session, abort)
+                   jsonify, g, session, abort, Response, stream_with_context,
+                   make_response, has_request_context)
 from flask_bootstrap import Bootstrap
 from flask_github import GitHub
+from werkzeug.datastructures import MultiDict
 
-from sqlalchemy import and_
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import (
+    and_, or_, select, exists, func, bindparam, literal, DateTime
+)
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.exc import SQLAlchemyError
 
-from datetime import date
+from datetime import date, datetime
+from collections import namedtuple
+from functools import partial, wraps
+from itertools import groupby
+import hashlib
+import json
+import os
+import time
 
 from forms import UpdateTopicForm, UpdateBookForm, DeleteForm, AddBookForm
-from helper import get_slug
+from slug_allocator import SlugAllocator
+from metrics import RequestMetrics, instrument_engine
+from slow_query_log import install_slow_query_log
+from search import index_books, remove_books, search_books
+from latest_books import (
+    refresh_latest_books, remove_latest_books, remove_topic_books,
+    select_book_ids_by_topic_slug
+)
+from facets import (
+    add_facets, adjust_facets, remove_facets, remove_topic_facet,
+    select_facets
+)
+from related_books import refresh_related_books, select_related_books
+from snapshot import ID_MASK, CatalogSnapshot, SnapshotHolder
+from cache import (
+    VersionedCache, VersionedLRUCache, get_catalog_state, bump_catalog_version
+)
 from db_bookshelf import (
-    User, Book, Topic, Author, BookAuthor, BookTopic, engine
+    User, Book, Topic, Author, BookAuthor, BookTopic, LatestBook, TopicBook,
+    BookTombstone, CatalogChange, engine, format_timestamp
 )
 from github_secrets import GITHUB_CLIENT_ID, GITHUB_CLIENT_SECRET
 
@@ -21,9 +50,49 @@ app = Flask(__name__)
 app.config["SECRET_KEY"] = "6RoG8rjAiYzHa4ijDTNtiEnC2XFxEwNsmexWb7pu"
 app.config["GITHUB_CLIENT_ID"] = GITHUB_CLIENT_ID
 app.config["GITHUB_CLIENT_SECRET"] = GITHUB_CLIENT_SECRET
+app.config["BOOKS_PER_PAGE"] = 20
+app.config["JSON_BATCH_SIZE"] = 500
+app.config["RESPONSE_CACHE_SIZE"] = 256
+# Total size of cached responses per process and the largest one, in bytes;
+# larger responses like the JSON export of a big catalog aren't cached
+app.config["RESPONSE_CACHE_BYTES"] = 32 * 1024 * 1024
+app.config["RESPONSE_CACHE_ENTRY_BYTES"] = 1024 * 1024
+app.config["SEARCH_RESULTS"] = 50
+app.config["BULK_BATCH_SIZE"] = 100
+# Authors with most books listed in the sidebar
+app.config["SIDEBAR_AUTHORS"] = 10
+# Serve overview, detail and JSON from an in-memory copy of the catalog
+app.config["SNAPSHOT_ENABLED"] = os.environ.get("BOOKSHELF_SNAPSHOT") == "1"
+# Statements are only timed if metrics are enabled at startup
+app.config["METRICS_ENABLED"] = os.environ.get("BOOKSHELF_METRICS") == "1"
+# Statements taking at least this many milliseconds are logged, 0 disables
+app.config["SLOW_QUERY_MS"] = float(
+    os.environ.get("BOOKSHELF_SLOW_QUERY_MS", 0))
+app.config["SLOW_QUERY_LOG"] = os.environ.get(
+    "BOOKSHELF_SLOW_QUERY_LOG", app.root_path + "/slow_queries.log")
 bootstrap = Bootstrap(app)
 github = GitHub(app)
-db_session = sessionmaker(bind=engine)()
+# One session per thread, removed at the end of each request
+db_session = scoped_session(sessionmaker(bind=engine))
+# Caches the construction and compilation of the helper lookups
+bakery = baked.bakery()
+book_slugs = SlugAllocator(Book)
+topic_slugs = SlugAllocator(Topic)
+NDJSON_MIMETYPE = "application/x-ndjson"
+# Maximum number of names per `IN` clause, SQLite allows 999 variables
+CHUNK_SIZE = 500
+# Joins author names aggregated by SQL, never part of a name
+AUTHOR_SEPARATOR = "\x1f"
+# Aggregates joining strings with a separator per dialect, MySQL's
+# `group_concat` needs `SEPARATOR` syntax and isn't listed
+STRING_AGGREGATES = dict(sqlite=func.group_concat,
+                         postgresql=func.string_agg)
+catalog_cache = VersionedCache()
+catalog_snapshot = SnapshotHolder()
+response_cache = VersionedLRUCache(app.config["RESPONSE_CACHE_SIZE"],
+                                   app.config["RESPONSE_CACHE_BYTES"],
+                                   app.config["RESPONSE_CACHE_ENTRY_BYTES"])
+request_metrics = RequestMetrics()
 
 
 """" SECTION: GITHUB AUTH LOGIC """
@@ -40,6 +109,15 @@ def before_request():
         g.id = session["id"]
 
 
+@app.teardown_appcontext
+def remove_db_session(exception: Exception=None) -> None:
+    """After each request, close the thread's session and return its
+    connection to the pool. Otherwise its identity map would keep every
+    object the thread has ever loaded.
+    """
+    db_session.remove()
+
+
 @github.access_token_getter
 def token_getter():
     """Return Github's auth token to make requests on the user's behalf."""
@@ -116,12 +194,146 @@ def authorized(oauth_token):
     return redirect(url_for("login_successful"))
 
 
+"""" SECTION: METRICS """
+
+
+def count_query(seconds: float) -> None:
+    """Attribute one SQL statement to the current request, if any."""
+    if has_request_context() and "sql_queries" in g:
+        g.sql_queries += 1
+        g.sql_seconds += seconds
+
+
+@app.before_request
+def start_request_metrics() -> None:
+    """Before each request, start timer and query counter."""
+    if app.config["METRICS_ENABLED"]:
+        g.request_started = time.perf_counter()
+        g.sql_queries = 0
+        g.sql_seconds = 0.0
+
+
+@app.after_request
+def remember_response_status(response: Response) -> Response:
+    """Keep status code of the response for `record_request_metrics`."""
+    if "request_started" in g:
+        g.response_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def record_request_metrics(exception: Exception=None) -> None:
+    """Record latency and SQL metrics of the request.
+
+    Teardown runs after streamed responses are consumed, so their queries
+    are included. Requests failing with an unhandled exception count as 500.
+    """
+    if "request_started" not in g:
+        return
+
+    request_metrics.observe(
+        request.endpoint or "none", request.method,
+        getattr(g, "response_status", 500),
+        time.perf_counter() - g.request_started,
+        g.sql_queries, g.sql_seconds
+    )
+
+
+@app.route("/metrics")
+def show_metrics() -> Response:
+    """Return request and SQL metrics in Prometheus text format.
+
+    Raises:
+        404: Metrics are disabled.
+    """
+    if not app.config["METRICS_ENABLED"]:
+        return abort(404)
+
+    return Response(request_metrics.render(),
+                    mimetype="text/plain; version=0.0.4")
+
+
+def current_route() -> str:
+    """Return endpoint and path of the current request, if any."""
+    if has_request_context():
+        return "{} {}".format(request.endpoint, request.full_path)
+
+
+if app.config["METRICS_ENABLED"]:
+    instrument_engine(engine, count_query)
+
+if app.config["SLOW_QUERY_MS"] > 0:
+    install_slow_query_log(engine, app.config["SLOW_QUERY_MS"],
+                           app.config["SLOW_QUERY_LOG"], current_route)
+
+
+"""" SECTION: RESPONSE CACHE """
+
+
+def cached_response(view: object) -> object:
+    """Decorator to serve anonymous GET requests from `response_cache`.
+
+    Responses only change with the catalog, so they are cached per catalog
+    version and URL. Each response carries a strong ETag derived from both
+    and the time of the last change as Last-Modified. Requests with a
+    matching "If-None-Match" or "If-Modified-Since" header are answered with
+    304 without calling the view.
+
+    Logged in users and pending flash messages bypass the cache, since they
+    change the rendered page. Streamed responses and responses larger than
+    `RESPONSE_CACHE_ENTRY_BYTES` are not stored, but get their ETag
+    nevertheless.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if g.token is not None or "_flashes" in session:
+            return view(*args, **kwargs)
+
+        version, updated_at = catalog_state()
+        # Same URL can be negotiated to different representations
+        key = (request.full_path, str(request.accept_mimetypes))
+        etag = "{}-{}".format(version, hashlib.sha1(
+            repr(key).encode("utf-8")).hexdigest()[:16])
+
+        if request.if_none_match:
+            is_modified = not request.if_none_match.contains(etag)
+        elif request.if_modified_since and updated_at is not None:
+            is_modified = updated_at > request.if_modified_since.replace(
+                tzinfo=None)
+        else:
+            is_modified = True
+
+        if not is_modified:
+            response = Response(status=304)
+        else:
+            cached = response_cache.get(version, key)
+            if cached is not None:
+                response = Response(cached[0], mimetype=cached[1])
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                if not response.is_streamed:
+                    body = response.get_data()
+                    response_cache.set(version, key,
+                                       (body, response.mimetype), len(body))
+
+        response.set_etag(etag)
+        response.last_modified = updated_at
+        response.headers["Cache-Control"] = "no-cache"
+        response.vary.update(("Accept", "Cookie"))
+        return response
+
+    return wrapper
+
+
 """" SECTION: READ TOPICS AND BOOKS """
 
 
 @app.route("/")
 @app.route("/<topic_slug>")
 @app.route("/<topic_slug>/")
+@cached_response
 def overview(topic_slug: str="") -> tuple:
     """Render `templates/overview.html` for "/" and "/<topic_slug>".
 
@@ -131,77 +343,171 @@ def overview(topic_slug: str="") -> tuple:
     Route "/<topic_slug>":
         Display only the books associated with the given `topic_slug`.
 
+    Both routes display `BOOKS_PER_PAGE` books. Query parameters `after` and
+    `before` take a cursor of the last or first book of the current page to
+    display the next or previous page, see `paginate_books`.
+
     Args:
         topic_slug: Unique human-friendly slug to identify topic.
 
     Raises:
         SQLAlchemyError: Given `topic_slug` not found in `bookshelf_db.Topic`.
             Abort with error code 404.
+        ValueError: Given cursor is invalid. Abort with error code 404.
     """
-    topic_list = db_session.query(Topic.name, Topic.slug).all()
+    snapshot = get_snapshot()
+    facets = catalog_cache.get(
+        "facets", catalog_version(),
+        lambda: select_facets(db_session, app.config["SIDEBAR_AUTHORS"])
+    )
 
     # TODO: How to alias fields in SQLAlchemy?
     # Example: Book.slug and Topic.slug have same key in result tuple
-    if len(topic_slug):
+    if snapshot is not None:
+        topic = snapshot.get_topic(topic_slug) if len(topic_slug) else None
+
+        # Return 404 in case of invalid `topic_slug`
+        if len(topic_slug) and topic is None:
+            return abort(404)
+
+        fetch_rows = partial(snapshot.select_page,
+                             topic.id if topic else None)
+        topic = topic.name if topic else ""
+    elif len(topic_slug):
         try:
             # Return 404 in case of invalid `topic_slug`
-            topic = get_topic_by_slug(topic_slug).name
-            book_list = (
-                db_session.query(Book.title, Book.slug, Topic.slug)
-                .join(BookTopic, Topic)
-                .filter(and_(Topic.slug == topic_slug))
-                .all()
-            )
+            topic = get_topic_by_slug(topic_slug)
         except SQLAlchemyError as sa_err:
             return abort(404, sa_err)
+
+        # Rows of the topic in `topic_book` are ordered by its index, so
+        # pages don't sort all books of the topic, see `latest_books.py`
+        book_query = (
+            db_session.query(TopicBook.title, TopicBook.book_slug,
+                             literal(topic.slug), TopicBook.pub_date,
+                             TopicBook.book_id)
+            .filter(TopicBook.topic_id == topic.id)
+        )
+        topic = topic.name
+        fetch_rows = query_book_rows(
+            book_query, (TopicBook.pub_date, TopicBook.book_id))
     else:
         topic = ""
-        # Group by BookTopic.book_id necessary to filter out books that belong
-        # multiple topics.
+        # Books can belong to multiple topics, but need only one for the link
+        # which `latest_book` holds already, see `latest_books.py`
         #
         # Example:
         # Book "Data Vis with Python and JavaScript" belongs to topics
         # "Python" and "JavaScript".
-        book_list = (
-            db_session.query(Book.title, Book.slug, Topic.slug)
-            .join(BookTopic, Topic)
-            .group_by(BookTopic.book_id)
-            .order_by(Book.pub_date.desc())
-            .all()
+        book_query = db_session.query(LatestBook.title, LatestBook.book_slug,
+                                      LatestBook.topic_slug,
+                                      LatestBook.pub_date, LatestBook.book_id)
+        fetch_rows = query_book_rows(
+            book_query, (LatestBook.pub_date, LatestBook.book_id))
+
+    try:
+        book_list, prev_cursor, next_cursor = paginate_books(
+            fetch_rows, request.args.get("after"), request.args.get("before")
         )
+    except ValueError as val_err:
+        return abort(404, val_err)
+
+    prev_url = next_url = None
+    if prev_cursor:
+        prev_url = url_for("overview", before=prev_cursor, **request.view_args)
+    if next_cursor:
+        next_url = url_for("overview", after=next_cursor, **request.view_args)
 
-    return render_template("overview.html", topics=topic_list, topic=topic,
-                           t_slug=topic_slug, books=book_list, user=g.token)
+    return render_template("overview.html", topics=facets["topics"],
+                           authors=facets["authors"], years=facets["years"],
+                           topic=topic,
+                           t_slug=topic_slug, books=book_list,
+                           prev_url=prev_url, next_url=next_url,
+                           user=g.token)
 
 
 @app.route("/<topic_slug>/<book_slug>")
 @app.route("/<topic_slug>/<book_slug>/")
+@cached_response
 def detail(topic_slug: str, book_slug: str) -> tuple:
     """Render `templates/detail.html` for "/<topic_slug>/<book_slug>".
 
     Route "/<topic_slug>/<book_slug>":
         Display all details associated with this book from `bookshelf_db.Book`.
-        Query for associated authors from `bookshelf_db.Author`.
+        Query for associated authors from `bookshelf_db.Author` and related
+        books from `bookshelf_db.RelatedBook`.
 
     Args:
         topic_slug: Unique human-friendly slug to identify topic.
         book_slug: Unique human-friendly slug to identify book.
 
-    Raises:
-        SQLAlchemyError: Given `topic_slug` or `book_slug` not found in
-            `bookshelf_db.Topic` or `bookshelf_db.Book` respectively. Abort
-            with error code 404.
+    Aborts with error code 404 if `book_slug` is not found in
+    `bookshelf_db.Book` or the book is not associated with `topic_slug`.
     """
-    try:
+    snapshot = get_snapshot()
+
+    if snapshot is not None:
+        book = snapshot.get_book(book_slug)
+        topic = snapshot.get_topic(topic_slug)
+
         # Return 404 in case of invalid `topic_slug` or `book_slug`
-        get_topic_by_slug(topic_slug)
-        book = get_book_by_slug(book_slug)
-        authors = get_authors_by_book_id(book.id)
-    except SQLAlchemyError as sa_err:
-        return abort(404, sa_err)
+        if book is None or topic is None or topic.id not in book.topic_ids:
+            return abort(404)
+
+        authors = snapshot.get_author_names(book)
+        related = snapshot.get_related_books(db_session, book)
+    else:
+        book = load_book_detail(topic_slug, book_slug)
+
+        # Return 404 in case of invalid `topic_slug` or `book_slug`
+        if book is None:
+            return abort(404)
+
+        authors = book.authors
+        related = select_related_books(db_session, book.id)
 
     return render_template("detail.html", book=book, authors=authors,
-                           t_slug=topic_slug, b_slug=book_slug, user=g.token)
+                           related=related, t_slug=topic_slug,
+                           b_slug=book_slug, user=g.token)
+
+
+"""" SECTION: SEARCH BOOKS """
+
+
+@app.route("/search")
+@app.route("/search/")
+@cached_response
+def search() -> tuple:
+    """Render `templates/search.html` for "/search?q=<query>".
+
+    Route "/search":
+        Display up to `SEARCH_RESULTS` books whose title, description or
+        author names contain all words of `q`, best matches first. See
+        `search.search_books`.
+    """
+    query = request.args.get("q", "").strip()
+    books = search_books(db_session, query, app.config["SEARCH_RESULTS"])
+
+    return render_template("search.html", query=query, books=books,
+                           user=g.token)
+
+
+@app.route("/search/JSON")
+@app.route("/search/JSON/")
+@cached_response
+def search_json():
+    """Return books matching query parameter `q` as JSON, best matches
+    first. Each book has its title, publication date and URL.
+    """
+    query = request.args.get("q", "").strip()
+    books = search_books(db_session, query, app.config["SEARCH_RESULTS"])
+
+    return jsonify(query=query, books=[{
+        "title": b.title,
+        "publication_date": b.pub_date.strftime("%B %Y"),
+        "url": url_for("detail", topic_slug=b.topic_slug, book_slug=b.slug,
+                       _external=True)
+    } for b in books])
 
 
 """" SECTION: ADD BOOKS """
@@ -230,44 +536,10 @@ def add_book():
     form = AddBookForm()
 
     if request.method == "POST" and form.validate_on_submit():
-        # Add new `Book` and remember id
-        pub_date = form.pub_date.data.split("-")
-        book = Book(title=form.title.data,
-                    isbn=form.isbn.data,
-                    description=form.description.data,
-                    slug=create_book_slug(form.title.data),
-                    owner_id=g.id,
-                    pub_date=date(int(pub_date[1]), int(pub_date[0]), 1))
-        db_session.add(book)
-        book_id = db_session.query(Book).filter_by(slug=book.slug).one().id
-
-        # Add new `Topic` if necessary and create new reference in `BookTopic`
-        for topic in form.topics.data.split(","):
-            topic = topic.strip()
-            topic_exists = len(get_topic_by_name(topic)) > 0
-
-            if not topic_exists:
-                db_session.add(
-                    Topic(name=topic, owner_id=g.id,
-                          slug=create_topic_slug(topic))
-                )
-
-            topic_id = get_topic_by_name(topic)[0].id
-            db_session.add(BookTopic(book_id=book_id, topic_id=topic_id))
-
-        # Add new `Author` if necessary and create reference in `BookAuthor`
-        for name in form.authors.data.split(","):
-            name = name.strip()
-            author_exists = len(get_author_by_name(name)) > 0
-
-            if not author_exists:
-                db_session.add(Author(name=name))
-
-            author_id = get_author_by_name(name)[0].id
-            db_session.add(BookAuthor(book_id=book.id, author_id=author_id))
-
         try:
             # Return 500 in case commit fails
+            books = create_books([form])
+            bump_catalog_version(db_session, [b.id for b, _ in books])
             db_session.commit()
         except SQLAlchemyError as sa_err:
             db_session.rollback()
@@ -280,6 +552,81 @@ def add_book():
         return render_template("add.html", form=form, user=g.token)
 
 
+@app.route("/books/bulk", methods=["POST"])
+@app.route("/books/bulk/", methods=["POST"])
+def bulk_add_books() -> tuple:
+    """Add many books at once for "/books/bulk".
+
+    Route POST "/books/bulk":
+        Accept a JSON array (`application/json`) or one entry per line
+        (`application/x-ndjson`) of entries in the shape of
+        `data/books.json`. Each entry is validated with the rules of
+        `forms.AddBookForm`. Valid entries are added in transactions of
+        `BULK_BATCH_SIZE` books, resolving topics and authors once per batch.
+
+    Returns:
+        JSON with counts of `created`, `invalid` and `failed` entries and one
+        result per entry in `results`, with the book's `url` if created or
+        the `errors` otherwise.
+
+    Raises:
+        401: User is not logged in.
+        415: Body is neither JSON nor NDJSON. Other content types would allow
+            cross-site form posts with the user's session.
+        ValueError: Body is not a JSON array. Abort with error code 400.
+    """
+    # User needs to be logged in to add books
+    if g.token is None:
+        return abort(401)
+
+    if request.mimetype not in ("application/json", NDJSON_MIMETYPE):
+        return abort(415)
+
+    try:
+        entries = parse_bulk_entries(request.get_data(as_text=True),
+                                     request.mimetype == NDJSON_MIMETYPE)
+    except ValueError as val_err:
+        return abort(400, val_err)
+
+    results = []
+    forms = []
+    for row, entry in enumerate(entries):
+        form, errors = validate_bulk_entry(entry)
+        if form is None:
+            results.append(dict(row=row, status="invalid", errors=errors))
+        else:
+            results.append(None)
+            forms.append((row, form))
+
+    batch_size = app.config["BULK_BATCH_SIZE"]
+    for i in range(0, len(forms), batch_size):
+        batch = forms[i:i + batch_size]
+        try:
+            books = create_books([f for _, f in batch])
+            bump_catalog_version(db_session, [b.id for b, _ in books])
+            db_session.commit()
+        except SQLAlchemyError as sa_err:
+            db_session.rollback()
+            for row, _ in batch:
+                results[row] = dict(row=row, status="failed",
+                                    errors=dict(database=[str(sa_err)]))
+            continue
+
+        for (row, _), (book, topic_slug) in zip(batch, books):
+            results[row] = dict(
+                row=row, status="created", slug=book.slug,
+                url=url_for("detail", topic_slug=topic_slug,
+                            book_slug=book.slug)
+            )
+
+    return jsonify(
+        created=sum(r["status"] == "created" for r in results),
+        invalid=sum(r["status"] == "invalid" for r in results),
+        failed=sum(r["status"] == "failed" for r in results),
+        results=results
+    )
+
+
 """" SECTION: EDIT TOPICS AND BOOKS """
 
 
@@ -323,14 +670,31 @@ def update_topic(topic_slug: str) -> tuple:
 
     if request.method == "POST" and form.validate_on_submit():
         if topic.name != form.name.data:
-            # Update slug if name has changed
-            if topic.name != form.name.data:
-                topic.name = form.name.data
-                topic.slug = create_topic_slug(topic.name)
+            # Topic names are unique
+            if db_session.query(Topic.id).filter(
+                    Topic.name == form.name.data).first() is not None:
+                flash("Topic \"{}\" already exists.".format(form.name.data),
+                      "danger")
+                return render_template("update.html", form=form,
+                                       name=topic.name, user=g.token)
 
             try:
                 # Return 500 in case commit fails
+                book_ids = select_book_ids_by_topic_slug(db_session,
+                                                         topic.slug)
+
+                # Update slug as name has changed
+                topic.name = form.name.data
+                topic.slug = create_topic_slug(topic.name)
                 db_session.add(topic)
+                db_session.flush()
+                refresh_latest_books(db_session, book_ids)
+
+                # Topic names are part of the JSON of all books of the topic
+                bump_catalog_version(db_session, [i for i, in (
+                    db_session.query(BookTopic.book_id)
+                    .filter_by(topic_id=topic.id)
+                )])
                 db_session.commit()
             except SQLAlchemyError as sa_err:
                 db_session.rollback()
@@ -366,19 +730,19 @@ def update_book(topic_slug: str, book_slug: str) -> tuple:
         topic_slug: Unique human-friendly slug to identify topic.
         book_slug: Unique human-friendly slug to identify book.
 
+    Aborts with error code 404 if `book_slug` is not found in
+    `bookshelf_db.Book` or the book is not associated with `topic_slug`.
+
     Raises:
-        SQLAlchemyError: Given `topic_slug` or `book_slug` not found in
-            `bookshelf_db.Topic` or `bookshelf_db.Book` respectively. Abort
-            with error code 404.
         SQLAlchemyError: Commit failed. Abort with error code 500.
     """
-    try:
-        # Return 404 in case of invalid `topic_slug` or `book_slug`
-        get_topic_by_slug(topic_slug)
-        book = get_book_by_slug(book_slug)
-        authors = get_authors_by_book_id(book.id)
-    except SQLAlchemyError as sa_err:
-        return abort(404, sa_err)
+    book = load_book_detail(topic_slug, book_slug)
+
+    # Return 404 in case of invalid `topic_slug` or `book_slug`
+    if book is None:
+        return abort(404)
+
+    authors = book.authors
 
     # User needs to be logged in to see this page
     if g.token is None:
@@ -392,37 +756,72 @@ def update_book(topic_slug: str, book_slug: str) -> tuple:
 
     if request.method == "POST" and form.validate_on_submit():
         try:
-            # Update slug if title has changed
-            if book.title != form.title.data:
-                book.title = form.title.data
-                book.slug = create_book_slug(book.title)
+            # Search index only needs a refresh if indexed fields change
+            is_indexed_changed = (book.title != form.title.data or
+                                  book.description != form.description.data)
 
-            # Update remaining `book` fields
-            book.description = form.description.data
-            book.isbn = form.isbn.data
+            # Update `book` fields
             pub_date = form.pub_date.data.split("-")
-            book.pub_date = date(int(pub_date[1]), int(pub_date[0]), 1)
-            db_session.add(book)
-
-            # Delete references in `BookAuthor`
-            delete_bookauthor_by_book_id(book.id)
-
-            # Create new authors if necessary
-            # Create entry in `BookAuthor`
-            for name in form.authors.data.split(","):
-                name = name.strip()
-                author_exists = len(get_author_by_name(name)) > 0
+            values = dict(
+                description=form.description.data,
+                isbn=form.isbn.data,
+                pub_date=date(int(pub_date[1]), int(pub_date[0]), 1)
+            )
 
-                if not author_exists:
-                    db_session.add(Author(name=name))
+            # Facets only change with the year and the authors
+            facet_changes = []
+            if book.pub_date.year != values["pub_date"].year:
+                facet_changes += [("year", book.pub_date.year, -1),
+                                  ("year", values["pub_date"].year, 1)]
 
-                author_id = get_author_by_name(name)[0].id
-                db_session.add(BookAuthor(book_id=book.id,
-                                          author_id=author_id))
+            # Update slug if title has changed
+            if book.title != form.title.data:
+                values.update(title=form.title.data,
+                              slug=create_book_slug(form.title.data))
 
-            # Delete all authors without entries in `BookAuthor`
-            delete_bookless_authors()
+            (
+                db_session.query(Book)
+                .filter_by(id=book.id)
+                .update(values, synchronize_session=False)
+            )
 
+            # Only write references in `BookAuthor` that actually changed
+            names = split_names(form.authors.data)
+            added = [n for n in names if n not in authors]
+            removed = [n for n in authors if n not in names]
+
+            if added:
+                # Create new authors if necessary
+                author_ids = resolve_author_ids(added)
+                db_session.execute(BookAuthor.__table__.insert(), [
+                    dict(book_id=book.id, author_id=a)
+                    for a in author_ids.values()
+                ])
+                facet_changes += [("author", a, 1)
+                                  for a in author_ids.values()]
+
+            if removed:
+                # Delete references and removed authors w/o other books
+                author_ids = list(dict(
+                    db_session.query(Author.name, Author.id)
+                    .filter(Author.name.in_(removed))
+                ).values())
+                (
+                    db_session.query(BookAuthor)
+                    .filter(and_(BookAuthor.book_id == book.id,
+                                 BookAuthor.author_id.in_(author_ids)))
+                    .delete(synchronize_session=False)
+                )
+                delete_bookless_authors(author_ids)
+                facet_changes += [("author", a, -1) for a in author_ids]
+
+            if is_indexed_changed or added or removed:
+                index_books(db_session, [book.id])
+            refresh_latest_books(db_session, [book.id])
+            adjust_facets(db_session, facet_changes)
+            if added or removed:
+                refresh_related_books(db_session, [book.id])
+            bump_catalog_version(db_session, [book.id])
             db_session.commit()
         except SQLAlchemyError as sa_err:
             db_session.rollback()
@@ -489,25 +888,33 @@ def delete_topic(topic_slug: str) -> tuple:
     if request.method == "POST" and form.validate_on_submit():
         try:
             # Return 500 in case commit fails
-            db_session.delete(topic)
+            # All books of the topic are either deleted or lose a topic
+            changed_ids = [i for i, in (
+                db_session.query(BookTopic.book_id)
+                .filter_by(topic_id=topic.id)
+            )]
 
-            # Delete references in BookTopic and then books w/o topics
-            delete_list(
+            # Delete books w/o other topics and then references in BookTopic
+            delete_books(select_topic_only_book_ids(topic.id))
+            book_ids = select_book_ids_by_topic_slug(db_session, topic.slug)
+            (
                 db_session.query(BookTopic)
                 .filter_by(topic_id=topic.id)
-                .all()
+                .delete(synchronize_session=False)
             )
-            delete_topicless_books()
-
-            # Delete references in BookAuthor and then authors w/o books
-            delete_list(
-                db_session.query(BookAuthor)
-                .outerjoin(Book)
-                .filter(and_(Book.id == None))  # `is None` does not work
-                .all()
+            remove_topic_books(db_session, topic.id)
+            (
+                db_session.query(Topic)
+                .filter_by(id=topic.id)
+                .delete(synchronize_session=False)
             )
-            delete_bookless_authors()
 
+            # Remaining books of the topic link to their next topic now
+            refresh_latest_books(db_session, book_ids)
+            remove_topic_facet(db_session, topic.id)
+            refresh_related_books(db_session, changed_ids, is_removal=True)
+
+            bump_catalog_version(db_session, changed_ids)
             db_session.commit()
         except SQLAlchemyError as sa_err:
             db_session.rollback()
@@ -566,19 +973,11 @@ def delete_book(topic_slug: str, book_slug: str) -> tuple:
     if request.method == "POST" and form.validate_on_submit():
         try:
             # Return 500 in case commit fails
-            db_session.delete(book)
-
-            # Delete references in BookAuthor and then authors w/o books
-            delete_bookauthor_by_book_id(book.id)
-            delete_bookless_authors()
+            # Delete book, its references and authors and topics w/o books
+            delete_books([book.id])
+            refresh_related_books(db_session, [book.id], is_removal=True)
 
-            # Delete references in BookTopic and then topics w/o books
-            delete_list(
-                db_session.query(BookTopic)
-                .filter_by(book_id=book.id)
-                .all()
-            )
-            delete_bookless_topics()
+            bump_catalog_version(db_session, [book.id])
             db_session.commit()
         except SQLAlchemyError as sa_err:
             db_session.rollback()
@@ -599,23 +998,118 @@ def delete_book(topic_slug: str, book_slug: str) -> tuple:
 @app.route("/JSON/")
 @app.route("/<topic_slug>/JSON")
 @app.route("/<topic_slug>/JSON/")
+@cached_response
 def handle_json(topic_slug: str=""):
-    if len(topic_slug):
+    """Return all books or books of `topic_slug` as JSON.
+
+    Each book includes the names of its authors and topics, see
+    `serialize_books`. Query parameter `format` selects how the books are
+    returned:
+        json (default): One JSON object `{"books": [...]}`
+        stream: Same JSON object, but encoded and sent in chunks while books
+            are fetched in batches of `JSON_BATCH_SIZE` rows
+        ndjson: Stream of `application/x-ndjson`, one book per line. Also
+            selected by header "Accept: application/x-ndjson".
+
+    Query parameter `since` of "/JSON" selects an incremental sync instead,
+    see `serialize_changes`. Returns 400 for a cursor that isn't a catalog
+    version.
+
+    Args:
+        topic_slug: Unique human-friendly slug to identify topic.
+
+    Raises:
+        SQLAlchemyError: Given `topic_slug` not found in `bookshelf_db.Topic`.
+            Abort with error code 404.
+    """
+    since = request.args.get("since")
+    if since is not None:
+        # Changes are logged for the whole catalog only
+        if len(topic_slug) or not since.isdigit():
+            return abort(400)
+
+        cursor = catalog_version()
+        if int(since) > cursor:
+            return abort(400)
+
+        return jsonify(serialize_changes(int(since), cursor))
+
+    snapshot = get_snapshot()
+    topic_id = None
+
+    if len(topic_slug) and snapshot is not None:
+        topic = snapshot.get_topic(topic_slug)
+
+        # Return 404 in case of invalid `topic_slug`
+        if topic is None:
+            return abort(404)
+
+        topic_id = topic.id
+    elif len(topic_slug):
         try:
             # Return 404 in case of invalid `topic_slug`
-            get_topic_by_slug(topic_slug)  # Necessary to throw exception
-            books = (
-                db_session.query(Book)
-                .join(BookTopic, Topic)
-                .filter(and_(Topic.slug == topic_slug))
-                .all()
-            )
+            topic_id = get_topic_by_slug(topic_slug).id
         except SQLAlchemyError as sa_err:
             return abort(404, sa_err)
+
+    if snapshot is not None:
+        books = snapshot.serialize_books(topic_id)
+    else:
+        books = serialize_books(topic_id)
+
+    json_format = request.args.get("format", "json")
+    if request.accept_mimetypes.best_match(
+            ["application/json", NDJSON_MIMETYPE]) == NDJSON_MIMETYPE:
+        json_format = "ndjson"
+
+    if json_format == "ndjson":
+        return Response(stream_with_context(stream_books(books, True)),
+                        mimetype=NDJSON_MIMETYPE)
+    elif json_format == "stream":
+        return Response(stream_with_context(stream_books(books)),
+                        mimetype="application/json")
     else:
-        books = db_session.query(Book).all()
+        return jsonify(books=list(books))
 
-    return jsonify(books=[b.serialize() for b in books])
+
+@app.route("/<topic_slug>/<book_slug>/JSON")
+@app.route("/<topic_slug>/<book_slug>/JSON/")
+@cached_response
+def handle_book_json(topic_slug: str, book_slug: str):
+    """Return one book as JSON, in the shape of `Book.serialize` with its
+    related books, best first.
+
+    Args:
+        topic_slug: Unique human-friendly slug to identify topic.
+        book_slug: Unique human-friendly slug to identify book.
+
+    Aborts with error code 404 if `book_slug` is not found in
+    `bookshelf_db.Book` or the book is not associated with `topic_slug`.
+    """
+    book = load_book_detail(topic_slug, book_slug)
+
+    # Return 404 in case of invalid `topic_slug` or `book_slug`
+    if book is None:
+        return abort(404)
+
+    data = next(serialize_books(book_ids=[book.id]))
+    data["related"] = [
+        dict(title=r.title, slug=r.slug, score=r.score,
+             url=url_for("detail", topic_slug=r.topic_slug,
+                         book_slug=r.slug, _external=True))
+        for r in select_related_books(db_session, book.id)
+    ]
+    return jsonify(data)
+
+
+@app.route("/facets/JSON")
+@app.route("/facets/JSON/")
+@cached_response
+def handle_facets_json():
+    """Return book counts per topic, author and publication year as JSON,
+    see `facets.select_facets`.
+    """
+    return jsonify(select_facets(db_session))
 
 
 """" SECTION: ERROR HANDLERS """
@@ -648,95 +1142,677 @@ def error_500(e: Exception) -> tuple:
 """" SECTION: HELPER FUNCTIONS TO RE-USE QUERIES """
 
 
+def catalog_state() -> tuple:
+    """Return tuple `(version, updated_at)` of the catalog, read at most once
+    per request.
+    """
+    if getattr(g, "catalog_state", None) is None:
+        g.catalog_state = get_catalog_state(db_session)
+    return g.catalog_state
+
+
+def catalog_version() -> int:
+    """Return catalog version, read at most once per request."""
+    return catalog_state()[0]
+
+
+def get_snapshot() -> CatalogSnapshot:
+    """Return catalog snapshot of the current version, or `None` if
+    `SNAPSHOT_ENABLED` is off. After a change of the catalog, the first
+    request refreshes the snapshot.
+    """
+    if not app.config["SNAPSHOT_ENABLED"]:
+        return None
+    return catalog_snapshot.get(db_session, catalog_version())
+
+
+# Columns of `Book` needed by pages of a single book, and its authors
+BookDetail = namedtuple("BookDetail", ["id", "title", "slug", "isbn",
+                                       "description", "pub_date", "owner_id",
+                                       "authors"])
+
+
+def load_book_detail(topic_slug: str, book_slug: str) -> BookDetail:
+    """Return book by `book_slug` with its author names.
+
+    Authors are aggregated by `STRING_AGGREGATES` and the topic is checked
+    with an `EXISTS` in the same baked query. Dialects without an aggregate
+    load the authors with `get_authors_by_book_id`.
+
+    Returns:
+        `BookDetail` or `None` if the book doesn't exist or isn't associated
+        with the topic `topic_slug`.
+    """
+    aggregate = STRING_AGGREGATES.get(db_session.bind.dialect.name)
+    query = bakery(lambda s: s.query(
+        Book.id, Book.title, Book.slug, Book.isbn, Book.description,
+        Book.pub_date, Book.owner_id,
+        exists().where(and_(
+            BookTopic.book_id == Book.id,
+            BookTopic.topic_id == Topic.id,
+            Topic.slug == bindparam("topic_slug")
+        ))
+    ))
+    query += lambda q: q.filter(Book.slug == bindparam("book_slug"))
+
+    if aggregate is not None:
+        query += lambda q: (
+            q.add_columns(aggregate(Author.name, AUTHOR_SEPARATOR))
+            .outerjoin(BookAuthor, BookAuthor.book_id == Book.id)
+            .outerjoin(Author, Author.id == BookAuthor.author_id)
+            .group_by(Book.id)
+        )
+
+    row = query(db_session()).params(topic_slug=topic_slug,
+                                     book_slug=book_slug).first()
+
+    if row is None or not row[7]:
+        return None
+
+    if aggregate is None:
+        authors = get_authors_by_book_id(row[0])
+    else:
+        authors = row[8].split(AUTHOR_SEPARATOR) if row[8] else []
+    return BookDetail(*(tuple(row[:7]) + (authors,)))
+
+
 def get_topic_by_slug(slug: str) -> Topic:
     """Return one `Topic` by given `slug`."""
-    return db_session.query(Topic).filter_by(slug=slug).one()
+    query = bakery(lambda s: s.query(Topic))
+    query += lambda q: q.filter(Topic.slug == bindparam("slug"))
+    return query(db_session()).params(slug=slug).one()
 
 
 def get_book_by_slug(slug: str) -> Book:
     """Return one `Book` by given `slug`."""
-    return db_session.query(Book).filter_by(slug=slug).one()
+    query = bakery(lambda s: s.query(Book))
+    query += lambda q: q.filter(Book.slug == bindparam("slug"))
+    return query(db_session()).params(slug=slug).one()
 
 
 def get_authors_by_book_id(book_id: int) -> list:
     """Return list of `Author.name` for given `book_id`."""
-    return [a[0] for a in (
-        db_session.query(Author.name)
-        .join(BookAuthor, Book)
-        .filter(and_(BookAuthor.book_id == book_id))
-        .all()
-    )]
+    query = bakery(lambda s: s.query(Author.name))
+    query += lambda q: q.join(BookAuthor, BookAuthor.author_id == Author.id)
+    query += lambda q: q.filter(BookAuthor.book_id == bindparam("book_id"))
+    return [a[0] for a in query(db_session()).params(book_id=book_id)]
+
+
+def split_names(text: str) -> list:
+    """Return list of unique, non-empty names in comma separated `text`."""
+    names = []
+    for name in text.split(","):
+        name = name.strip()
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+def create_books(forms: list) -> list:
+    """Add one book per validated `forms.AddBookForm` owned by the current
+    user, together with missing topics and authors and all references.
+
+    Topics and authors of all forms are resolved at once, so the number of
+    statements grows with the number of books, not with their names. The
+    caller bumps the catalog version and commits.
+
+    Returns:
+        List of tuples `(book, topic_slug)` in order of `forms`, where
+        `topic_slug` is the slug of the book's canonical topic.
+    """
+    books = []
+    for form in forms:
+        pub_date = form.pub_date.data.split("-")
+        book = Book(title=form.title.data,
+                    isbn=form.isbn.data,
+                    description=form.description.data,
+                    slug=create_book_slug(form.title.data),
+                    owner_id=g.id,
+                    pub_date=date(int(pub_date[1]), int(pub_date[0]), 1))
+        db_session.add(book)
+        books.append(book)
+    db_session.flush()
+
+    topic_names = [split_names(f.topics.data) for f in forms]
+    author_names = [split_names(f.authors.data) for f in forms]
+    topic_ids = resolve_topic_ids(unique_names(topic_names))
+    author_ids = resolve_author_ids(unique_names(author_names))
+
+    # Add new references in `BookTopic` and `BookAuthor`
+    topic_rows = [dict(book_id=book.id, topic_id=topic_ids[name])
+                  for book, names in zip(books, topic_names)
+                  for name in names]
+    author_rows = [dict(book_id=book.id, author_id=author_ids[name])
+                   for book, names in zip(books, author_names)
+                   for name in names]
+
+    # An empty executemany would insert one row of `NULL`s
+    if topic_rows:
+        db_session.execute(BookTopic.__table__.insert(), topic_rows)
+    if author_rows:
+        db_session.execute(BookAuthor.__table__.insert(), author_rows)
+
+    book_ids = [book.id for book in books]
+    index_books(db_session, book_ids)
+    refresh_latest_books(db_session, book_ids)
+    add_facets(db_session, book_ids)
+    refresh_related_books(db_session, book_ids)
+
+    # Topic with the lowest id is the canonical one, as in `latest_book`
+    slugs = dict(db_session.query(Topic.id, Topic.slug)
+                 .filter(Topic.id.in_(topic_ids.values())))
+    return [(book, slugs.get(min((topic_ids[n] for n in names),
+                                 default=None)))
+            for book, names in zip(books, topic_names)]
+
+
+def unique_names(names_per_book: list) -> list:
+    """Return unique names of a list of name lists, in order."""
+    names = []
+    seen = set()
+    for name in (n for book_names in names_per_book for n in book_names):
+        if name not in seen:
+            seen.add(name)
+            names.append(name)
+    return names
+
+
+def parse_bulk_entries(text: str, is_ndjson: bool) -> list:
+    """Return entries of a bulk request body.
+
+    Lines of NDJSON that are not valid JSON become `None` entries, which are
+    reported as invalid rows.
+
+    Raises:
+        ValueError: JSON body is not an array.
+    """
+    if not is_ndjson:
+        entries = json.loads(text)
+        if not isinstance(entries, list):
+            raise ValueError("Expected JSON array of books.")
+        return entries
+
+    entries = []
+    for line in text.splitlines():
+        if line.strip():
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                entries.append(None)
+    return entries
+
+
+def validate_bulk_entry(entry: object) -> tuple:
+    """Validate one entry in the shape of `data/books.json` with the rules
+    of `forms.AddBookForm`.
+
+    Returns:
+        Tuple `(form, errors)`, where `form` is `None` if validation failed.
+    """
+    if not isinstance(entry, dict):
+        return None, dict(entry=["Expected JSON object."])
+
+    def join(value: object) -> str:
+        if isinstance(value, list):
+            return ", ".join(str(v) for v in value)
+        return "" if value is None else str(value)
+
+    form = AddBookForm(formdata=MultiDict(dict(
+        title=join(entry.get("title")),
+        authors=join(entry.get("authors")),
+        topics=join(entry.get("topics")),
+        isbn=join(entry.get("isbn")),
+        pub_date=join(entry.get("publication_date")),
+        description=join(entry.get("description")),
+    )), meta=dict(csrf=False))
+
+    if not form.validate():
+        return None, form.errors
+    return form, None
+
+
+def resolve_topic_ids(names: list) -> dict:
+    """Return dict of `Topic.name` -> `Topic.id` for `names`. Missing topics
+    are created and owned by the current user.
+    """
+    return resolve_ids(Topic, names, lambda name: dict(
+        name=name, owner_id=g.id, slug=create_topic_slug(name)
+    ))
+
+
+def resolve_author_ids(names: list) -> dict:
+    """Return dict of `Author.name` -> `Author.id` for `names`. Missing
+    authors are created.
+    """
+    return resolve_ids(Author, names, lambda name: dict(name=name))
+
+
+def resolve_ids(model: object, names: list, create_row: object) -> dict:
+    """Return dict of name -> id for `names` of `model`, create missing rows.
+
+    Existing rows are looked up with `IN` queries of up to `CHUNK_SIZE`
+    names and missing rows are inserted with one multi-row `INSERT`, followed
+    by more `IN` queries for their ids. The number of statements grows with
+    `len(names) / CHUNK_SIZE`, plus what `create_row` executes.
+
+    Args:
+        model: `Topic` or `Author`
+        names: List of unique names
+        create_row: Function that returns the values for a new row by name
+    """
+    def select_ids(names: list) -> dict:
+        ids = {}
+        for i in range(0, len(names), CHUNK_SIZE):
+            ids.update(
+                db_session.query(model.name, model.id)
+                .filter(model.name.in_(names[i:i + CHUNK_SIZE]))
+            )
+        return ids
+
+    ids = select_ids(names)
+    missing = [n for n in names if n not in ids]
+
+    if missing:
+        db_session.execute(model.__table__.insert(),
+                           [create_row(n) for n in missing])
+        ids.update(select_ids(missing))
+
+    return ids
+
+
+def paginate_books(fetch_rows: object, after: str=None,
+                   before: str=None) -> tuple:
+    """Return one page of books, newest books first.
+
+    Books are ordered by `(pub_date, id)` and pages are selected by comparing
+    against the cursor of a neighbouring page instead of using OFFSET.
+    Therefore every page costs the same as the first one.
+
+    Args:
+        fetch_rows: Function `(after, before, limit)` that returns up to
+            `limit` rows ending with `pub_date` and `id`, either newest first
+            older than `after` or oldest first newer than `before`, both
+            tuples `(pub_date, id)` or `None`. See `query_book_rows` and
+            `snapshot.CatalogSnapshot.select_page`.
+        after: Cursor of last book of previous page, to get next page
+        before: Cursor of first book of next page, to get previous page
+
+    Returns:
+        Tuple `(rows, prev_cursor, next_cursor)`. Cursors are `None` if there
+        is no previous or next page.
+
+    Raises:
+        ValueError: Given cursor is invalid.
+    """
+    per_page = app.config["BOOKS_PER_PAGE"]
+
+    # Fetch one more row to know whether there is another page
+    if before:
+        rows = fetch_rows(None, parse_book_cursor(before), per_page + 1)
+    else:
+        rows = fetch_rows(parse_book_cursor(after) if after else None, None,
+                          per_page + 1)
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+
+    # Rows before the cursor come oldest first
+    if before:
+        rows.reverse()
+
+    if not rows:
+        return rows, None, None
 
+    prev_cursor = next_cursor = None
+    if after or (before and has_more):
+        prev_cursor = create_book_cursor(rows[0])
+    if before or has_more:
+        next_cursor = create_book_cursor(rows[-1])
 
-def get_topic_by_name(name: str) -> list:
-    """Return all `Topic` objects matching given `name`."""
-    return db_session.query(Topic).filter_by(name=name).all()
+    return rows, prev_cursor, next_cursor
 
 
-def get_author_by_name(name: str) -> list:
-    """Return all `Author` objects matching given `name`."""
-    return db_session.query(Author).filter_by(name=name).all()
+def query_book_rows(query: object,
+                    order_by: tuple=(Book.pub_date, Book.id)) -> object:
+    """Return function to fetch rows of `query` for `paginate_books`.
+
+    Args:
+        query: Query for rows of books, ending with the columns of `order_by`
+        order_by: Columns of publication date and book id in `query`, e.g.
+            of `LatestBook`
+    """
+    pub_date_column, id_column = order_by
+
+    def fetch_rows(after: tuple, before: tuple, limit: int) -> list:
+        rows = query
+        if before:
+            pub_date, book_id = before
+            rows = rows.filter(or_(
+                pub_date_column > pub_date,
+                and_(pub_date_column == pub_date, id_column > book_id)
+            ))
+        elif after:
+            pub_date, book_id = after
+            rows = rows.filter(or_(
+                pub_date_column < pub_date,
+                and_(pub_date_column == pub_date, id_column < book_id)
+            ))
+
+        # Walk backwards from `before` and reverse result afterwards
+        if before:
+            rows = rows.order_by(pub_date_column.asc(), id_column.asc())
+        else:
+            rows = rows.order_by(pub_date_column.desc(), id_column.desc())
+
+        return rows.limit(limit).all()
+
+    return fetch_rows
+
+
+def create_book_cursor(row: tuple) -> str:
+    """Return cursor for a book row ending with `pub_date` and `id`."""
+    return "{}_{}".format(row[-2].strftime("%Y-%m-%d"), row[-1])
+
+
+def parse_book_cursor(cursor: str) -> tuple:
+    """Return tuple `(pub_date, id)` for cursor from `create_book_cursor`.
+
+    Raises:
+        ValueError: Given cursor is invalid.
+    """
+    pub_date, book_id = cursor.split("_")
+    book_id = int(book_id)
+
+    # Ids out of range would overflow into the sort keys of other books in
+    # `snapshot.create_key`
+    if not 0 <= book_id <= ID_MASK:
+        raise ValueError("Book id {} of cursor out of range".format(book_id))
+
+    return datetime.strptime(pub_date, "%Y-%m-%d").date(), book_id
+
+
+def serialize_books(topic_id: int=None, book_ids: object=None,
+                    serialize: str="serialize"):
+    """Yield all books or books of `topic_id` serialized by `Book.serialize`.
+
+    Books, author names and topic names are fetched by three queries, all
+    ordered by book id, and merged while iterating. The number of queries
+    does not depend on the number of books and rows are fetched in batches
+    of `JSON_BATCH_SIZE`.
+
+    Args:
+        topic_id: Only serialize books associated with this topic
+        book_ids: Only serialize books with ids in this select
+        serialize: Name of the method of `Book` to serialize with
+    """
+    batch_size = app.config["JSON_BATCH_SIZE"]
+    books = db_session.query(Book).order_by(Book.id)
+    authors = (
+        db_session.query(BookAuthor.book_id, Author.name)
+        .join(Author)
+        .order_by(BookAuthor.book_id, BookAuthor.author_id)
+    )
+    topics = (
+        db_session.query(BookTopic.book_id, Topic.name)
+        .join(Topic)
+        .order_by(BookTopic.book_id, BookTopic.topic_id)
+    )
+
+    if topic_id is not None:
+        book_ids = (
+            select([BookTopic.book_id])
+            .where(BookTopic.topic_id == topic_id)
+        )
+
+    if book_ids is not None:
+        books = books.filter(Book.id.in_(book_ids))
+        authors = authors.filter(BookAuthor.book_id.in_(book_ids))
+        topics = topics.filter(BookTopic.book_id.in_(book_ids))
+
+    author_groups = group_names_by_book(authors.yield_per(batch_size))
+    topic_groups = group_names_by_book(topics.yield_per(batch_size))
+    next(author_groups)
+    next(topic_groups)
+
+    for book in books.yield_per(batch_size):
+        yield getattr(book, serialize)(authors=author_groups.send(book.id),
+                                       topics=topic_groups.send(book.id))
+
+
+def serialize_changes(since: int, cursor: int) -> dict:
+    """Return books changed and deleted after catalog version `since` up to
+    `cursor`, for consumers that keep a copy of the catalog in sync.
+
+    Changed books are listed in `catalog_change` and still exist, deleted
+    books are listed there, but don't exist anymore. Their slugs come from
+    `book_tombstone`. A cursor of 0 returns all books. Books changed after
+    `cursor` may be returned already and are returned again next time.
+
+    Returns:
+        Dictionary with `cursor` to pass as `since` next time, `books` as
+        serialized by `Book.serialize_change` and `deleted` as dictionaries
+        with `id`, `slug` and `deleted_at`.
+    """
+    if not since:
+        return dict(cursor=cursor, deleted=[], books=list(
+            serialize_books(serialize="serialize_change")))
+
+    changes = CatalogChange.__table__
+    tombstones = BookTombstone.__table__
+    changed_ids = (
+        select([changes.c.book_id])
+        .where(and_(changes.c.version > since, changes.c.version <= cursor))
+    )
+    deleted = db_session.execute(
+        select([changes.c.book_id, tombstones.c.slug, tombstones.c.deleted_at])
+        .distinct()
+        .select_from(changes.outerjoin(
+            tombstones, tombstones.c.book_id == changes.c.book_id))
+        .where(and_(changes.c.version > since, changes.c.version <= cursor,
+                    ~exists().where(Book.id == changes.c.book_id)))
+        .order_by(changes.c.book_id)
+    )
+
+    return dict(
+        cursor=cursor,
+        books=list(serialize_books(book_ids=changed_ids,
+                                   serialize="serialize_change")),
+        deleted=[dict(id=i, slug=slug, deleted_at=format_timestamp(at))
+                 for i, slug, at in deleted]
+    )
+
+
+def group_names_by_book(rows: object):
+    """Coroutine to look up names in rows `(book_id, name)` ordered by
+    `book_id`.
+
+    Prime with `next` and send book ids in ascending order to receive the
+    list of names for each of them. Rows are consumed only as far as
+    necessary.
+    """
+    groups = groupby(rows, key=lambda r: r[0])
+    group_id, names = next(groups, (None, ()))
+    book_id = yield
+
+    while True:
+        while group_id is not None and group_id < book_id:
+            group_id, names = next(groups, (None, ()))
+
+        if group_id == book_id:
+            book_id = yield [n for _, n in names]
+        else:
+            book_id = yield []
+
+
+def stream_books(books: object, ndjson: bool=False):
+    """Yield JSON encoded books in chunks.
+
+    Books are encoded in batches of `JSON_BATCH_SIZE`, so the encoded payload
+    of all books is never held in memory at once.
+
+    Args:
+        books: Iterable of serialized books, see `serialize_books`
+        ndjson: Encode one book per line instead of `{"books": [...]}`
+    """
+    batch_size = app.config["JSON_BATCH_SIZE"]
+    batch = []
+    is_first = True
+
+    if not ndjson:
+        yield '{"books": ['
+
+    for book in books:
+        batch.append(json.dumps(book))
+
+        if len(batch) == batch_size:
+            yield encode_batch(batch, ndjson, is_first)
+            batch = []
+            is_first = False
+
+    if batch:
+        yield encode_batch(batch, ndjson, is_first)
+
+    if not ndjson:
+        yield "]}\n"
+
+
+def encode_batch(batch: list, ndjson: bool, is_first: bool) -> str:
+    """Join a batch of JSON encoded books for `stream_books`."""
+    if ndjson:
+        return "".join(b + "\n" for b in batch)
+
+    return ("" if is_first else ", ") + ", ".join(batch)
 
 
 def create_book_slug(title: str) -> str:
     """Return unique slug for `Book`."""
-    return get_slug([b.slug for b in db_session.query(Book).all()], title)
+    return book_slugs.allocate(db_session, title)
 
 
 def create_topic_slug(name: str) -> str:
     """Return unique slug for `Topic`."""
-    return get_slug([t.slug for t in (db_session.query(Topic).all())], name)
+    return topic_slugs.allocate(db_session, name)
 
 
-def delete_bookauthor_by_book_id(book_id: int) -> None:
-    """Delete all references in `BookAuthor` matching given `book_id`."""
-    delete_list(
-        db_session.query(BookAuthor)
-        .filter_by(book_id=book_id)
-        .all()
-    )
+"""Deletes below are bulk `DELETE` statements, which run in a constant
+number of round trips and never load the deleted rows into the session.
+Objects of deleted rows that are already in the session are not updated.
+"""
 
 
-def delete_bookless_authors() -> None:
-    """Delete all `Author` objects without references in `BookAuthor`."""
-    delete_list(
+def delete_bookless_authors(author_ids: list=None) -> None:
+    """Delete all `Author` objects without references in `BookAuthor`.
+
+    Args:
+        author_ids: Only check these authors instead of the whole table
+    """
+    query = (
         db_session.query(Author)
-        .outerjoin(BookAuthor)
-        .filter(BookAuthor.author_id == None)  # `is None` doesn't work
-        .all()
+        .filter(~exists().where(BookAuthor.author_id == Author.id))
     )
+    if author_ids is not None:
+        query = query.filter(Author.id.in_(author_ids))
 
+    query.delete(synchronize_session=False)
 
-def delete_bookless_topics() -> None:
-    """Delete all `Topic` objects without references in `BookTopic`."""
-    delete_list(
-        db_session.query(Topic)
-        .outerjoin(BookTopic)
-        .filter(BookTopic.topic_id == None)  # `is None` doesn't work
-        .all()
-    )
 
-
-def delete_topicless_books() -> None:
-    """Delete all `Book` objects without references in `BookTopic`."""
-    delete_list(
-        db_session.query(Book)
-        .outerjoin(BookTopic)
-        .filter(BookTopic.book_id == None)  # `is None` doesn't work
-        .all()
+def select_topic_only_book_ids(topic_id: int) -> object:
+    """Return select of ids of books that belong to `topic_id` and no other
+    topic, i.e. the books to delete together with the topic.
+    """
+    topic_books = BookTopic.__table__.alias()
+    other_topics = BookTopic.__table__.alias()
+
+    return (
+        select([topic_books.c.book_id])
+        .where(and_(
+            topic_books.c.topic_id == topic_id,
+            ~exists().where(and_(
+                other_topics.c.book_id == topic_books.c.book_id,
+                other_topics.c.topic_id != topic_id
+            )).correlate(topic_books)
+        ))
+        .correlate(None)
     )
 
 
-def delete_list(db_list: list) -> None:
-    """Delete a list of SQLAlchemy objects.
+def delete_books(book_ids: object) -> None:
+    """Delete books, their references in `BookAuthor` and `BookTopic`, as
+    well as authors and topics that have no other books. Records a
+    `BookTombstone` for each book.
+
+    Statements are ordered such that `book_ids` may be a select on
+    `BookTopic`, e.g. `select_topic_only_book_ids`: its references in
+    `BookTopic` are deleted last.
 
-    Necessary because `session.delete` can only delete single elements.
+    Args:
+        book_ids: List of ids or select of ids
     """
-    for l in db_list:
-        db_session.delete(l)
+    remove_facets(db_session, book_ids)
+
+    other_books = BookAuthor.__table__.alias()
+    (
+        db_session.query(Author)
+        .filter(and_(
+            Author.id.in_(
+                select([BookAuthor.author_id])
+                .where(BookAuthor.book_id.in_(book_ids))
+                .correlate(None)
+            ),
+            ~exists().where(and_(
+                other_books.c.author_id == Author.id,
+                ~other_books.c.book_id.in_(book_ids)
+            ))
+        ))
+        .delete(synchronize_session=False)
+    )
+
+    other_books = BookTopic.__table__.alias()
+    (
+        db_session.query(Topic)
+        .filter(and_(
+            Topic.id.in_(
+                select([BookTopic.topic_id])
+                .where(BookTopic.book_id.in_(book_ids))
+                .correlate(None)
+            ),
+            ~exists().where(and_(
+                other_books.c.topic_id == Topic.id,
+                ~other_books.c.book_id.in_(book_ids)
+            ))
+        ))
+        .delete(synchronize_session=False)
+    )
+
+    remove_books(db_session, book_ids)
+    remove_latest_books(db_session, book_ids)
+
+    # Ids of deleted books are reused by SQLite, keep the newest tombstone
+    tombstones = BookTombstone.__table__
+    db_session.execute(
+        tombstones.delete().where(tombstones.c.book_id.in_(book_ids)))
+    db_session.execute(tombstones.insert().from_select(
+        ["book_id", "slug", "deleted_at"],
+        select([Book.id, Book.slug, literal(datetime.utcnow(), DateTime)])
+        .where(Book.id.in_(book_ids))
+    ))
+    (
+        db_session.query(BookAuthor)
+        .filter(BookAuthor.book_id.in_(book_ids))
+        .delete(synchronize_session=False)
+    )
+    (
+        db_session.query(Book)
+        .filter(Book.id.in_(book_ids))
+        .delete(synchronize_session=False)
+    )
+    (
+        db_session.query(BookTopic)
+        .filter(BookTopic.book_id.in_(book_ids))
+        .delete(synchronize_session=False)
+    )
 
 if __name__ == '__main__':
     # Automatically reload changed Jinja templates
     app.jinja_env.auto_reload = True
     app.config['TEMPLATES_AUTO_RELOAD'] = True
-    app.run(host="0.0.0.0", port=5000)
+    app.run(host="0.0.0.0", port=5000, threaded=True)
@@ -0,0 +1,557 @@
+#!/usr/bin/env python
+
+"""Run this module to benchmark the app against a synthetic catalog.
+
+A benchmark run has three steps:
+
+1. `generate_catalog` writes a reproducible NDJSON catalog of configurable
+   size. Topics and authors are drawn from skewed distributions and authors
+   tend to publish with the same co-authors, so fan-out resembles a real
+   catalog rather than a uniform one.
+2. `load_catalog` creates a fresh database and loads the catalog through
+   `db_prefill.bulk_import`.
+3. `run_scenarios` drives routes through the Flask test client from
+   concurrent threads and reports latency percentiles, queries per request
+   and peak RSS for each route.
+
+With `--lookups`, step 3 is replaced by `run_lookups`, a micro-benchmark of
+the baked lookups that routes of `app` run per request against the same
+queries built on every call.
+
+Results are printed as JSON and can be written to a file to compare runs:
+
+    python3 benchmark.py --books 20000 --output before.json
+    python3 benchmark.py --books 20000 --output after.json \
+        --compare before.json
+
+The database URL is read by `db_bookshelf` at import time, therefore the app
+and the prefill module are imported by `load_app` once the URL is set.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from bisect import bisect
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import accumulate
+from sqlalchemy import and_, event, exists, func, select
+
+WORDS = [
+    "python", "data", "learning", "machine", "deep", "web", "cloud", "design",
+    "patterns", "systems", "networks", "security", "algorithms", "analysis",
+    "programming", "javascript", "rust", "go", "databases", "distributed",
+    "functional", "testing", "science", "statistics", "linux", "kernel",
+    "compilers", "graphics", "mobile", "architecture", "microservices",
+    "visualization", "concurrency", "performance", "agile", "devops",
+    "containers", "typescript", "haskell", "scala", "modern", "practical",
+]
+FIRST_NAMES = [
+    "Ada", "Alan", "Anna", "Barbara", "Brian", "Carol", "Dennis", "Donald",
+    "Edsger", "Frances", "Grace", "Guido", "Hedy", "John", "Ken", "Linus",
+    "Margaret", "Niklaus", "Radia", "Robert", "Sophie", "Tim", "Yukihiro",
+]
+LAST_NAMES = [
+    "Allen", "Berners", "Codd", "Dijkstra", "Floyd", "Goldberg", "Hamilton",
+    "Hopper", "Kernighan", "Knuth", "Lamarr", "Liskov", "Lovelace", "McCarthy",
+    "Perlman", "Pike", "Ritchie", "Rossum", "Thompson", "Torvalds", "Turing",
+    "Wilson", "Wirth",
+]
+
+# Weights of the number of topics and authors per book, starting at 1
+TOPIC_FAN_OUT = [60, 30, 10]
+AUTHOR_FAN_OUT = [50, 30, 15, 5]
+
+# Probability that a co-author is picked from the first author's team
+TEAM_PROBABILITY = 0.7
+TEAM_SIZE = 4
+
+SCENARIOS = ["overview", "detail", "handle_json", "add_book", "delete_topic"]
+OWNER_ID = 1
+
+
+"""" SECTION: CATALOG """
+
+
+def create_sampler(rng: random.Random, size: int, skew: float=1.0) -> object:
+    """Return function that draws indexes in `range(size)` with Zipf-like
+    probabilities, i.e. index 0 is drawn most often.
+    """
+    weights = list(accumulate(1.0 / (i + 1) ** skew for i in range(size)))
+    total = weights[-1]
+
+    def sample() -> int:
+        return bisect(weights, rng.random() * total)
+
+    return sample
+
+
+def pick_count(rng: random.Random, weights: list) -> int:
+    """Return number between 1 and `len(weights)` with given weights."""
+    sums = list(accumulate(weights))
+    return bisect(sums, rng.random() * sums[-1]) + 1
+
+
+def create_names(rng: random.Random, count: int, parts: list) -> list:
+    """Return `count` unique names combined from the word lists in `parts`.
+
+    Names get a numeric suffix once all combinations are used up.
+    """
+    names = []
+    seen = set()
+
+    while len(names) < count:
+        name = " ".join(rng.choice(words) for words in parts)
+        if name in seen:
+            name = "{} {}".format(name, len(names))
+        if name not in seen:
+            seen.add(name)
+            names.append(name)
+
+    return names
+
+
+def generate_catalog(path: str, books: int=10000, topics: int=200,
+                     authors: int=5000, seed: int=0) -> None:
+    """Write a synthetic catalog as NDJSON in `data/books.json` shape.
+
+    The same arguments always produce the same file.
+
+    Args:
+        path: File that will be written
+        books: Number of books
+        topics: Size of the topic pool
+        authors: Size of the author pool
+        seed: Seed of the random generator
+    """
+    rng = random.Random(seed)
+    topic_words = [w.title() for w in WORDS]
+    topic_names = create_names(rng, topics, [topic_words, topic_words])
+    author_names = create_names(rng, authors, [FIRST_NAMES, LAST_NAMES])
+    sample_topic = create_sampler(rng, topics)
+    sample_author = create_sampler(rng, authors, skew=0.8)
+
+    with open(path, "w") as catalog:
+        for _ in range(books):
+            title_words = rng.sample(WORDS, rng.randint(2, 5))
+
+            book_topics = set()
+            for _ in range(pick_count(rng, TOPIC_FAN_OUT)):
+                book_topics.add(topic_names[sample_topic()])
+
+            # Co-authors are likely to be the first author's usual team
+            first = sample_author()
+            book_authors = set([author_names[first]])
+            for _ in range(pick_count(rng, AUTHOR_FAN_OUT) - 1):
+                if rng.random() < TEAM_PROBABILITY:
+                    mate = (first + rng.randint(1, TEAM_SIZE)) % authors
+                else:
+                    mate = sample_author()
+                book_authors.add(author_names[mate])
+
+            catalog.write(json.dumps({
+                "title": " ".join(title_words).title(),
+                "publication_date": "{:02d}-{}".format(
+                    rng.randint(1, 12), rng.randint(1990, 2020)),
+                "isbn": "978{:010d}".format(rng.randrange(10 ** 10)),
+                "authors": sorted(book_authors),
+                "description": " ".join(
+                    rng.choice(WORDS) for _ in range(rng.randint(20, 60))
+                ).capitalize() + ".",
+                "topics": sorted(book_topics),
+            }) + "\n")
+
+
+def load_app(database_url: str) -> tuple:
+    """Point `db_bookshelf` to `database_url` and return the modules `app`,
+    `db_bookshelf`, `db_migrate` and `db_prefill`.
+    """
+    os.environ["BOOKSHELF_DATABASE_URL"] = database_url
+    import app
+    import db_bookshelf
+    import db_migrate
+    import db_prefill
+
+    app.app.config["WTF_CSRF_ENABLED"] = False
+    return app, db_bookshelf, db_migrate, db_prefill
+
+
+def load_catalog(modules: tuple, path: str, batch_size: int=1000) -> float:
+    """Create all tables, import catalog at `path` in bulk and score
+    related books.
+
+    Returns:
+        Import time in seconds.
+    """
+    _, db_bookshelf, db_migrate, db_prefill = modules
+    db_bookshelf.init_db()
+    db_migrate.upgrade()
+
+    started = time.time()
+    db_prefill.bulk_import(path, batch_size=batch_size, owner_id=OWNER_ID,
+                           progress=None, related=True)
+    return time.time() - started
+
+
+"""" SECTION: SCENARIOS """
+
+
+def create_jobs(modules: tuple, rng: random.Random, name: str,
+                count: int) -> list:
+    """Return list of `count` requests `(method, url, form data)` for the
+    scenario `name`.
+    """
+    db_bookshelf = modules[1]
+    Book, BookTopic, Topic = (db_bookshelf.Book, db_bookshelf.BookTopic,
+                              db_bookshelf.Topic)
+    engine = db_bookshelf.engine
+    topic_slugs = [s for s, in engine.execute(select([Topic.slug]))]
+    canonical = (
+        select([BookTopic.book_id, func.min(BookTopic.topic_id).label("tid")])
+        .group_by(BookTopic.book_id).alias()
+    )
+    book_links = engine.execute(
+        select([Topic.slug, Book.slug])
+        .select_from(canonical.join(Book, Book.id == canonical.c.book_id)
+                     .join(Topic, Topic.id == canonical.c.tid))
+    ).fetchall()
+
+    if name == "overview":
+        return [("GET", "/{}".format(
+            rng.choice(topic_slugs) + "/" if i % 2 else ""), None)
+            for i in range(count)]
+    if name == "detail":
+        return [("GET", "/{}/{}/".format(*rng.choice(book_links)), None)
+                for _ in range(count)]
+    if name == "handle_json":
+        return [("GET", "/{}/JSON/".format(rng.choice(topic_slugs)), None)
+                for _ in range(count)]
+    if name == "add_book":
+        topic_names = [n for n, in engine.execute(select([Topic.name]))]
+        return [("POST", "/add/", {
+            "title": "Benchmark Book {}".format(i),
+            "authors": "Benchmark Author {}, Benchmark Author {}".format(
+                i, i % 10),
+            "topics": ", ".join(rng.sample(topic_names, 2)),
+            "isbn": "979{:010d}".format(i),
+            "pub_date": "01-2020",
+            "description": "Added by benchmark.",
+        }) for i in range(count)]
+    if name == "delete_topic":
+        slugs = rng.sample(topic_slugs, min(count, len(topic_slugs)))
+        return [("POST", "/{}/delete/".format(s), {}) for s in slugs]
+
+    raise ValueError("Unknown scenario {}".format(name))
+
+
+def percentile(values: list, p: float) -> float:
+    """Return nearest-rank percentile `p` of sorted `values`."""
+    if not values:
+        return 0.0
+    rank = max(int(round(p / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def run_scenario(modules: tuple, jobs: list, concurrency: int=4,
+                 authenticated: bool=True) -> dict:
+    """Send `jobs` through the Flask test client from `concurrency` threads.
+
+    Queries are counted per thread, since the test client handles a request
+    in the calling thread.
+
+    Returns:
+        Dictionary with latency percentiles in milliseconds, queries per
+        request, status codes, throughput and peak RSS in KiB.
+    """
+    flask_app = modules[0].app
+    engine = modules[1].engine
+    local = threading.local()
+
+    def count_query(*args) -> None:
+        local.queries += 1
+
+    def request(job: tuple) -> tuple:
+        if not hasattr(local, "client"):
+            local.client = flask_app.test_client()
+            if authenticated:
+                with local.client.session_transaction() as sess:
+                    sess["token"] = "benchmark"
+                    sess["id"] = OWNER_ID
+
+        method, url, data = job
+        local.queries = 0
+        started = time.perf_counter()
+        response = local.client.open(url, method=method, data=data)
+        response.get_data()
+        response.close()
+        return time.perf_counter() - started, local.queries, \
+            response.status_code
+
+    event.listen(engine, "before_cursor_execute", count_query)
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(request, jobs))
+    finally:
+        event.remove(engine, "before_cursor_execute", count_query)
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(r[0] * 1000 for r in results)
+    queries = [r[1] for r in results]
+    statuses = {}
+    for r in results:
+        statuses[str(r[2])] = statuses.get(str(r[2]), 0) + 1
+
+    return {
+        "requests": len(results),
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(results) / max(elapsed, 1e-6), 1),
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "max_ms": round(latencies[-1], 2) if latencies else 0.0,
+        "queries_per_request": round(sum(queries) / max(len(queries), 1), 2),
+        "max_queries": max(queries) if queries else 0,
+        "status": statuses,
+        # High-water mark of the whole process, Linux reports KiB
+        "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run_scenarios(modules: tuple, names: list=SCENARIOS,
+                  requests: int=200, concurrency: int=4, seed: int=0,
+                  cached: bool=False) -> dict:
+    """Run each scenario in `names` and return results by name.
+
+    Read-only scenarios run as anonymous users if `cached` is set and will
+    be answered from the response cache after the first request. Writes
+    always run as the owner of the catalog.
+    """
+    rng = random.Random(seed)
+    results = {}
+
+    for name in names:
+        jobs = create_jobs(modules, rng, name, requests)
+        is_write = name in ("add_book", "delete_topic")
+        results[name] = run_scenario(
+            modules, jobs, concurrency=concurrency,
+            authenticated=is_write or not cached)
+
+    return results
+
+
+"""" SECTION: LOOKUPS """
+
+
+def create_plain_lookups(modules: tuple) -> dict:
+    """Return the lookups of `app` used by routes as plain queries that are
+    built and compiled on every call, by name.
+    """
+    app, db_bookshelf = modules[0], modules[1]
+    session = app.db_session
+    Author, Book, BookAuthor, BookTopic, Topic = (
+        db_bookshelf.Author, db_bookshelf.Book, db_bookshelf.BookAuthor,
+        db_bookshelf.BookTopic, db_bookshelf.Topic)
+
+    def load_book_detail(topic_slug: str, book_slug: str) -> tuple:
+        return session.query(
+            Book.id, Book.title, Book.slug, Book.isbn, Book.description,
+            Book.pub_date, Book.owner_id,
+            exists().where(and_(BookTopic.book_id == Book.id,
+                                BookTopic.topic_id == Topic.id,
+                                Topic.slug == topic_slug)),
+            func.group_concat(Author.name, app.AUTHOR_SEPARATOR)
+        ).outerjoin(BookAuthor, BookAuthor.book_id == Book.id) \
+            .outerjoin(Author, Author.id == BookAuthor.author_id) \
+            .filter(Book.slug == book_slug).group_by(Book.id).first()
+
+    return {
+        "get_topic_by_slug":
+            lambda slug: session.query(Topic).filter_by(slug=slug).one(),
+        "get_book_by_slug":
+            lambda slug: session.query(Book).filter_by(slug=slug).one(),
+        "load_book_detail": load_book_detail,
+    }
+
+
+def run_lookups(modules: tuple, calls: int=2000, seed: int=0) -> dict:
+    """Time `calls` calls of each lookup, plain and baked.
+
+    Both variants run in one thread with the same arguments, drawn from the
+    catalog. The session is expunged after every call, so neither variant
+    is answered from the identity map.
+
+    Returns:
+        Dictionary by lookup name with the mean time per call in
+        microseconds of both variants and the speedup.
+    """
+    app, db_bookshelf = modules[0], modules[1]
+    engine = db_bookshelf.engine
+    Book, BookTopic, Topic = (db_bookshelf.Book, db_bookshelf.BookTopic,
+                              db_bookshelf.Topic)
+    rng = random.Random(seed)
+    arguments = {
+        "get_topic_by_slug": select([Topic.slug]),
+        "get_book_by_slug": select([Book.slug]),
+        "load_book_detail": select([Topic.slug, Book.slug]).select_from(
+            BookTopic.__table__
+            .join(Topic, Topic.id == BookTopic.topic_id)
+            .join(Book, Book.id == BookTopic.book_id)),
+    }
+    plain = create_plain_lookups(modules)
+    results = {}
+
+    for name, statement in arguments.items():
+        rows = [tuple(row) for row in engine.execute(statement)]
+        args = [rng.choice(rows) for _ in range(calls)]
+        timings = {}
+
+        for variant, lookup in (("plain", plain[name]),
+                                ("baked", getattr(app, name))):
+            # Warm up connection, mappers and the bakery
+            lookup(*args[0])
+            started = time.perf_counter()
+            for arg in args:
+                lookup(*arg)
+                app.db_session.expunge_all()
+            timings[variant] = (time.perf_counter() - started) / calls * 1e6
+
+        app.db_session.remove()
+        results[name] = {
+            "calls": calls,
+            "plain_us": round(timings["plain"], 1),
+            "baked_us": round(timings["baked"], 1),
+            "speedup": round(timings["plain"] / max(timings["baked"], 1e-6),
+                             2),
+        }
+
+    return results
+
+
+"""" SECTION: REPORT """
+
+
+def print_summary(results: dict, baseline: dict=None) -> None:
+    """Print one line per scenario to stderr, with the relative change of
+    p50 and p95 compared to `baseline` if given.
+    """
+    print("{:<14} {:>8} {:>9} {:>9} {:>9} {:>8}".format(
+        "scenario", "req/s", "p50 ms", "p95 ms", "p99 ms", "queries"),
+        file=sys.stderr)
+
+    for name, r in results.items():
+        line = "{:<14} {:>8} {:>9} {:>9} {:>9} {:>8}".format(
+            name, r["requests_per_second"], r["p50_ms"], r["p95_ms"],
+            r["p99_ms"], r["queries_per_request"])
+
+        old = (baseline or {}).get(name)
+        if old:
+            line += "   p50 {:+.0%} p95 {:+.0%}".format(
+                r["p50_ms"] / max(old["p50_ms"], 1e-6) - 1,
+                r["p95_ms"] / max(old["p95_ms"], 1e-6) - 1)
+        print(line, file=sys.stderr)
+
+
+def print_lookups(results: dict) -> None:
+    """Print one line per helper lookup to stderr."""
+    print("{:<24} {:>10} {:>10} {:>8}".format(
+        "lookup", "plain us", "baked us", "speedup"), file=sys.stderr)
+    for name, r in results.items():
+        print("{:<24} {:>10} {:>10} {:>7}x".format(
+            name, r["plain_us"], r["baked_us"], r["speedup"]),
+            file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark bookshelf with a synthetic catalog.")
+    parser.add_argument("--books", type=int, default=10000,
+                        help="number of generated books")
+    parser.add_argument("--topics", type=int, default=200,
+                        help="size of the generated topic pool")
+    parser.add_argument("--authors", type=int, default=5000,
+                        help="size of the generated author pool")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed for catalog and requests")
+    parser.add_argument("--database",
+                        help="SQLite file to use; an existing file is "
+                             "benchmarked as it is (default: temporary file)")
+    parser.add_argument("--requests", type=int, default=200,
+                        help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="number of client threads")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                        help="scenario to run, can be repeated "
+                             "(default: all)")
+    parser.add_argument("--cached", action="store_true",
+                        help="read anonymously to measure the response "
+                             "cache")
+    parser.add_argument("--lookups", type=int, metavar="CALLS",
+                        help="instead of the scenarios, time CALLS calls "
+                             "of each route lookup, plain and baked")
+    parser.add_argument("--output", help="write results as JSON to file")
+    parser.add_argument("--compare",
+                        help="results file of an earlier run to compare to")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bookshelf-benchmark-")
+    # Only a database given with `--database` outlives the run
+    database = args.database or os.path.join(workdir, "bookshelf.db")
+    modules = None
+    try:
+        is_new = not os.path.exists(database)
+        modules = load_app("sqlite:///" + os.path.abspath(database))
+
+        report = {
+            "created_at": datetime.utcnow().isoformat() + "Z",
+            "python": platform.python_version(),
+            "database": database,
+            "concurrency": args.concurrency,
+            "cached": args.cached,
+            "catalog": None,
+        }
+
+        if is_new:
+            catalog_file = os.path.join(workdir, "catalog.ndjson")
+            generate_catalog(catalog_file, books=args.books,
+                             topics=args.topics, authors=args.authors,
+                             seed=args.seed)
+            report["catalog"] = {
+                "books": args.books, "topics": args.topics,
+                "authors": args.authors, "seed": args.seed,
+                "load_seconds": round(load_catalog(modules, catalog_file), 3),
+            }
+
+        if args.lookups:
+            report["lookups"] = run_lookups(modules, calls=args.lookups,
+                                            seed=args.seed)
+            print_lookups(report["lookups"])
+        else:
+            report["scenarios"] = run_scenarios(
+                modules, names=args.scenario or SCENARIOS,
+                requests=args.requests, concurrency=args.concurrency,
+                seed=args.seed, cached=args.cached)
+
+            baseline = None
+            if args.compare:
+                with open(args.compare, "r") as old_report:
+                    baseline = json.load(old_report)["scenarios"]
+            print_summary(report["scenarios"], baseline)
+
+        text = json.dumps(report, indent=2, sort_keys=True)
+        if args.output:
+            with open(args.output, "w") as output:
+                output.write(text + "\n")
+        else:
+            print(text)
+    finally:
+        if modules is not None:
+            modules[1].engine.dispose()
+        shutil.rmtree(workdir, ignore_errors=True)
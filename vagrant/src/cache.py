@@ -0,0 +1,171 @@
+"""In-process caches for data that changes only when the catalog changes.
+
+Every write path that changes books, topics or authors bumps the catalog
+version stored in table `catalog_version` within its own transaction, see
+`bump_catalog_version`. Cached values remember the version they were loaded
+at and are reloaded as soon as the version changed. Since the version lives
+in the database, writes in one worker process invalidate the caches of all
+other processes, too.
+
+`VersionedCache` holds a few values like the topic list, `VersionedLRUCache`
+holds a bounded number of values like rendered responses.
+"""
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import select
+
+from db_bookshelf import Book, CatalogChange, CatalogVersion
+
+CATALOG_VERSION_ID = 1
+
+
+def get_catalog_state(bind: object) -> tuple:
+    """Return tuple `(version, updated_at)` of the catalog, `bind` is a
+    session or connection. Before the first change it is `(0, None)`.
+    """
+    table = CatalogVersion.__table__
+    row = bind.execute(
+        select([table.c.version, table.c.updated_at])
+        .where(table.c.id == CATALOG_VERSION_ID)
+    ).first()
+    return tuple(row) if row is not None else (0, None)
+
+
+def bump_catalog_version(bind: object, book_ids: list=()) -> None:
+    """Increment catalog version, `bind` is a session or connection.
+
+    Call it in the same transaction as the change of the catalog, so the
+    new version becomes visible together with the new data. Ids of added,
+    changed or deleted books are recorded in `catalog_change` with the new
+    version, so readers like `snapshot.CatalogSnapshot` and sync consumers
+    of "/JSON?since=" can catch up without reloading the whole catalog.
+    `Book.updated_at` of the books that still exist is set, too.
+
+    Changes of topics alone need no ids for the snapshot, but renaming a
+    topic changes the JSON of its books, so pass their ids.
+    """
+    table = CatalogVersion.__table__
+    now = datetime.utcnow().replace(microsecond=0)
+    updated = bind.execute(
+        table.update().where(table.c.id == CATALOG_VERSION_ID)
+        .values(version=table.c.version + 1, updated_at=now)
+    )
+    if not updated.rowcount:
+        bind.execute(table.insert().values(id=CATALOG_VERSION_ID, version=1,
+                                           updated_at=now))
+
+    if book_ids:
+        version = (
+            select([table.c.version])
+            .where(table.c.id == CATALOG_VERSION_ID)
+            .as_scalar()
+        )
+        changes = CatalogChange.__table__
+        bind.execute(changes.insert().values(version=version),
+                     [dict(book_id=i) for i in book_ids])
+        bind.execute(
+            Book.__table__.update()
+            .where(Book.id.in_(select([changes.c.book_id])
+                               .where(changes.c.version == version)))
+            .values(updated_at=datetime.utcnow())
+        )
+
+
+class VersionedCache:
+    """Thread-safe cache of values loaded at a specific catalog version.
+
+    Example:
+        topics = cache.get("topics", version, load_topics)
+        Calls `load_topics` only if "topics" is missing or was loaded at
+        another catalog version than `version`.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, key: object, version: int, load: object) -> object:
+        """Return value for `key`, call `load` if cached value is stale."""
+        with self.lock:
+            entry = self.entries.get(key)
+
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        value = load()
+        with self.lock:
+            self.entries[key] = (version, value)
+        return value
+
+    def clear(self) -> None:
+        """Remove all values."""
+        with self.lock:
+            self.entries.clear()
+
+
+class VersionedLRUCache:
+    """Thread-safe cache of at most `max_size` values of the newest catalog
+    version, taking at most `max_bytes` together.
+
+    When a value is accessed with a newer version than before, all values of
+    older versions are dropped. Beyond `max_size` values or `max_bytes`, the
+    least recently used values are dropped. Values larger than
+    `max_entry_bytes` are not stored at all.
+    """
+
+    def __init__(self, max_size: int, max_bytes: int,
+                 max_entry_bytes: int):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.version = None
+
+    def get(self, version: int, key: object) -> object:
+        """Return value for `key` at `version` or `None` if missing."""
+        with self.lock:
+            self.drop_older(version)
+            if self.version != version or key not in self.entries:
+                return None
+
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def set(self, version: int, key: object, value: object,
+            size: int) -> None:
+        """Store value of `size` bytes for `key`, unless `version` is
+        outdated already or the value is too large.
+        """
+        if size > self.max_entry_bytes:
+            return
+
+        with self.lock:
+            self.drop_older(version)
+            if self.version != version:
+                return
+
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self.entries[key] = (value, size)
+            self.bytes += size
+            while len(self.entries) > self.max_size or \
+                    self.bytes > self.max_bytes:
+                self.bytes -= self.entries.popitem(last=False)[1][1]
+
+    def drop_older(self, version: int) -> None:
+        """Drop all values if `version` is newer, caller holds the lock."""
+        if self.version is None or version > self.version:
+            self.entries.clear()
+            self.bytes = 0
+            self.version = version
+
+    def clear(self) -> None:
+        """Remove all values."""
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+"""Run this module to upgrade an existing `bookshelf.db` in place.
+
+`init_db` creates missing tables, but never alters tables that already exist.
+Changes to existing tables, like new indexes, are applied by the versioned
+migrations in `MIGRATIONS`. Applied versions are recorded in table
+`schema_version`, so each migration runs once per database.
+
+Each migration names the tables, indexes and columns it adds, so upgrading a
+database of the original schema runs every migration in turn. Migrations are
+idempotent. They can run against a database that was just created by
+`init_db` and will only record their version there.
+"""
+import argparse
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.engine import Connection
+
+from db_bookshelf import BOOK_FTS_DDL, Base, SchemaVersion, engine
+from search import has_index, rebuild_index
+from latest_books import rebuild_latest_books, rebuild_topic_books
+from facets import rebuild_facets
+from related_books import clear_stale, rebuild_related_books
+
+# Indexes added to the tables of the original schema by migration 1
+BASELINE_INDEXES = [
+    "ix_user_github_id", "ix_topic_name", "ix_topic_slug", "ix_author_name",
+    "ix_book_pub_date", "ix_book_slug", "ix_book_isbn",
+    "ix_book_topic_topic_id_book_id", "ix_book_author_author_id_book_id",
+]
+
+
+def create_missing_tables(conn: Connection, names: list) -> None:
+    """Create tables `names` declared in `db_bookshelf` with their indexes,
+    unless they exist.
+    """
+    for name in names:
+        Base.metadata.tables[name].create(conn, checkfirst=True)
+
+
+def create_missing_indexes(conn: Connection, names: list) -> None:
+    """Create indexes `names` declared in `db_bookshelf`, unless they exist.
+    """
+    inspector = inspect(conn)
+    indexes = dict((i.name, i) for table in Base.metadata.sorted_tables
+                   for i in table.indexes)
+
+    for name in names:
+        index = indexes[name]
+        existing = inspector.get_indexes(index.table.name)
+        if name not in set(i["name"] for i in existing):
+            index.create(conn)
+
+
+def add_missing_columns(conn: Connection, names: list) -> None:
+    """Add columns `names` like "table.column" declared in `db_bookshelf`,
+    unless they exist. New columns must be nullable or have a server default.
+    """
+    inspector = inspect(conn)
+
+    for name in names:
+        table_name, column_name = name.split(".")
+        existing = inspector.get_columns(table_name)
+        if column_name not in set(c["name"] for c in existing):
+            column = Base.metadata.tables[table_name].c[column_name]
+            conn.execute("ALTER TABLE {} ADD COLUMN {}".format(
+                table_name, CreateColumn(column).compile(conn)
+            ))
+
+
+def add_indexes(conn: Connection) -> None:
+    """Add unique and secondary indexes to the original tables and table
+    `slug_counter`.
+    """
+    create_missing_tables(conn, ["slug_counter"])
+    create_missing_indexes(conn, BASELINE_INDEXES)
+
+
+def create_catalog_version(conn: Connection) -> None:
+    """Create table `catalog_version`."""
+    create_missing_tables(conn, ["catalog_version"])
+
+
+def add_catalog_updated_at(conn: Connection) -> None:
+    """Add column `catalog_version.updated_at`."""
+    add_missing_columns(conn, ["catalog_version.updated_at"])
+
+
+def create_search_index(conn: Connection) -> None:
+    """Create full-text index `book_fts` on SQLite with FTS5 and index all
+    books.
+    """
+    if has_index(conn):
+        conn.execute(BOOK_FTS_DDL)
+        rebuild_index(conn)
+
+
+def create_latest_books(conn: Connection) -> None:
+    """Create table `latest_book` and fill it with all books."""
+    create_missing_tables(conn, ["latest_book"])
+    rebuild_latest_books(conn)
+
+
+def create_catalog_change(conn: Connection) -> None:
+    """Create table `catalog_change`."""
+    create_missing_tables(conn, ["catalog_change"])
+
+
+def add_change_log(conn: Connection) -> None:
+    """Add timestamps of `book` and table `book_tombstone`."""
+    create_missing_tables(conn, ["book_tombstone"])
+    add_missing_columns(conn, ["book.created_at", "book.updated_at"])
+
+
+def create_facets(conn: Connection) -> None:
+    """Create table `facet_count` and count all books."""
+    create_missing_tables(conn, ["facet_count"])
+    rebuild_facets(conn)
+
+
+def create_related_books(conn: Connection) -> None:
+    """Create table `related_book` and score all books."""
+    create_missing_tables(conn, ["related_book"])
+    rebuild_related_books(conn)
+
+
+def create_related_books_stale(conn: Connection) -> None:
+    """Create table `related_book_stale`."""
+    create_missing_tables(conn, ["related_book_stale"])
+
+
+def create_related_common_features(conn: Connection) -> None:
+    """Create table `related_common_feature` and score all books again,
+    with common features counted by `facet_count`.
+    """
+    create_missing_tables(conn, ["related_common_feature"])
+    rebuild_related_books(conn)
+    clear_stale(conn)
+
+
+def create_topic_books(conn: Connection) -> None:
+    """Create table `topic_book` and fill it with all books."""
+    create_missing_tables(conn, ["topic_book"])
+    rebuild_topic_books(conn)
+
+
+"""List of migrations as tuples `(version, description, function)`.
+
+Append new migrations with the next version number. Never change what
+released migrations add.
+"""
+MIGRATIONS = [
+    (1, "Add unique and secondary indexes", add_indexes),
+    (2, "Add table catalog_version", create_catalog_version),
+    (3, "Add column catalog_version.updated_at", add_catalog_updated_at),
+    (4, "Add full-text index book_fts", create_search_index),
+    (5, "Add read model latest_book", create_latest_books),
+    (6, "Add table catalog_change", create_catalog_change),
+    (7, "Add columns book.created_at, book.updated_at and table "
+        "book_tombstone", add_change_log),
+    (8, "Add facet counts facet_count", create_facets),
+    (9, "Add related books related_book", create_related_books),
+    (10, "Add table related_book_stale", create_related_books_stale),
+    (11, "Add table related_common_feature",
+     create_related_common_features),
+    (12, "Add read model topic_book", create_topic_books),
+]
+
+
+@contextmanager
+def transaction(conn: Connection) -> Connection:
+    """Run the block in one transaction that includes DDL.
+
+    pysqlite doesn't begin transactions before DDL, and before Python 3.6 it
+    even commits before DDL. On SQLite, the driver's transaction handling is
+    switched off and `BEGIN`, `COMMIT` and `ROLLBACK` are issued explicitly.
+
+    Yields:
+        Connection to run the statements of the transaction on.
+    """
+    if conn.dialect.name != "sqlite":
+        with conn.begin():
+            yield conn
+        return
+
+    dbapi_connection = conn.connection.connection
+    isolation_level = dbapi_connection.isolation_level
+    dbapi_connection.isolation_level = None
+    manual = conn.execution_options(autocommit=False)
+
+    try:
+        manual.execute("BEGIN")
+        try:
+            yield manual
+        except Exception:
+            # A failed statement may have rolled back already
+            if dbapi_connection.in_transaction:
+                manual.execute("ROLLBACK")
+            raise
+        manual.execute("COMMIT")
+    finally:
+        dbapi_connection.isolation_level = isolation_level
+
+
+def applied_versions(conn: Connection) -> set:
+    """Return set of versions recorded in `schema_version`."""
+    SchemaVersion.__table__.create(conn, checkfirst=True)
+    return set(v for v, in conn.execute(
+        SchemaVersion.__table__.select()
+        .with_only_columns([SchemaVersion.version])
+    ))
+
+
+def upgrade(bind: object=engine) -> list:
+    """Apply all pending migrations to `bind`.
+
+    Each migration runs in its own transaction together with the record of
+    its version, DDL included, see `transaction`. If a migration fails, e.g.
+    because existing rows violate a new unique index, the exception is
+    raised, its changes are rolled back and the version is not recorded.
+    Fix the data and run again.
+
+    Returns:
+        List of applied versions.
+    """
+    applied = []
+
+    with bind.connect() as conn:
+        done = applied_versions(conn)
+
+        for version, description, migrate in MIGRATIONS:
+            if version in done:
+                continue
+
+            with transaction(conn) as migration_conn:
+                migrate(migration_conn)
+                migration_conn.execute(
+                    SchemaVersion.__table__.insert(), version=version,
+                    description=description, applied_at=datetime.utcnow())
+            applied.append(version)
+
+    return applied
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Upgrade bookshelf.db.")
+    parser.add_argument("--status", action="store_true",
+                        help="list migrations without applying them")
+    args = parser.parse_args()
+
+    if args.status:
+        with engine.connect() as connection:
+            versions = applied_versions(connection)
+        for v, d, _ in MIGRATIONS:
+            print("{:>4} {:<8} {}".format(
+                v, "applied" if v in versions else "pending", d))
+    else:
+        for v in upgrade():
+            print("Applied migration {}".format(v))
@@ -1,9 +1,21 @@
 #!/usr/bin/env python
+import argparse
 import json
 import sys
+import time
+from collections import OrderedDict
+from sqlalchemy import func, select
 from sqlalchemy.orm import sessionmaker
 from datetime import date
-from helper import get_slug
+from helper import create_slug, get_slug
+from slug_allocator import SlugAllocator
+from cache import bump_catalog_version
+from search import index_book_range, rebuild_index
+from latest_books import (
+    add_latest_book_range, rebuild_latest_books, rebuild_topic_books
+)
+from facets import add_facets, rebuild_facets
+from related_books import clear_stale, mark_stale, rebuild_related_books
 from db_bookshelf import (
     Topic, Book, Author, BookTopic, BookAuthor, User, engine
 )
@@ -124,9 +136,254 @@ def prepopulate_db():
                 session.add(BookAuthor(book_id=book_id, author_id=author_id))
 
     # Commit changes to database and close connection
+    session.flush()
+    rebuild_index(session)
+    rebuild_latest_books(session)
+    rebuild_topic_books(session)
+    rebuild_facets(session)
+    rebuild_related_books(session)
+    clear_stale(session)
+    bump_catalog_version(session, [i for i, in session.query(Book.id)])
     session.commit()
     session.close()
 
 
+def parse_pub_date(text: str) -> date:
+    """Return `date` for a publication date in format "MM-YYYY"."""
+    pub_date = text.split("-")
+    return date(int(pub_date[1]), int(pub_date[0]), 1)
+
+
+def iter_entries(data_file, chunk_size: int=64 * 1024):
+    """Yield entries from an open JSON file one at a time.
+
+    Unlike `json.load`, the file is read in chunks of `chunk_size` characters,
+    so memory use does not depend on the size of the file. Both a JSON array
+    of entries (like `data/books.json`) and newline-delimited JSON (one entry
+    per line) are accepted.
+
+    Raises:
+        ValueError: File content is not valid JSON.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    is_array = None
+    is_eof = False
+
+    while True:
+        # Skip whitespace and, inside an array, the separating commas
+        while pos < len(buffer) and (buffer[pos].isspace() or
+                                     (is_array and buffer[pos] == ",")):
+            pos += 1
+
+        if pos == len(buffer) or is_array is None:
+            if pos == len(buffer):
+                if is_eof:
+                    return
+                buffer, pos = data_file.read(chunk_size), 0
+                is_eof = len(buffer) == 0
+                continue
+
+            is_array = buffer[pos] == "["
+            pos += 1 if is_array else 0
+            continue
+
+        if is_array and buffer[pos] == "]":
+            return
+
+        try:
+            entry, end = decoder.raw_decode(buffer, pos)
+        except ValueError:
+            # Entry is incomplete, read the next chunk unless there is none
+            if is_eof:
+                raise
+            chunk = data_file.read(chunk_size)
+            is_eof = len(chunk) == 0
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+
+        pos = end
+        yield entry
+
+
+def print_progress(books: int, rows: int, seconds: float) -> None:
+    """Print import progress to stderr."""
+    print("Imported {} books, {} rows ({:.0f} rows/s)".format(
+        books, rows, rows / max(seconds, 1e-6)), file=sys.stderr)
+
+
+def bulk_import(json_file: str, batch_size: int=1000, owner_id: int=1,
+                progress=print_progress, related: bool=False) -> int:
+    """Import a large JSON file into database connected to
+    `bookshelf_db.engine`.
+
+    Other than `prepopulate_db`, entries are parsed incrementally and all
+    lookups are answered by in-memory maps (name -> id for topics and
+    authors, sets of used slugs), so import time grows linearly with the
+    number of entries. Ids are assigned upfront, which allows to insert
+    books, topics, authors and the junction rows of `batch_size` entries with
+    a single multi-row statement per table in one transaction. The counters
+    of `slug_allocator.SlugAllocator` are written in the same transaction.
+
+    Args:
+        json_file: Path to JSON array or NDJSON file in `data/books.json` shape
+        batch_size: Number of entries committed per transaction
+        owner_id: Github id of the user that will own new books and topics
+        progress: Called after each batch with number of books, number of
+            rows and elapsed seconds; `None` to disable
+        related: Rebuild related books after the import, otherwise they are
+            marked stale for `related_books.py`
+
+    Returns:
+        Number of imported books.
+    """
+    tables = (Book.__table__, Topic.__table__, Author.__table__,
+              BookTopic.__table__, BookAuthor.__table__)
+    conn = engine.connect()
+
+    with conn.begin():
+        if conn.execute(
+            User.__table__.select().where(User.github_id == owner_id)
+        ).first() is None:
+            conn.execute(User.__table__.insert(), github_id=owner_id)
+
+    # In-memory caches replace the per entry queries of `prepopulate_db`
+    topic_ids = dict(conn.execute(
+        Topic.__table__.select().with_only_columns([Topic.name, Topic.id])
+    ).fetchall())
+    author_ids = dict(conn.execute(
+        Author.__table__.select().with_only_columns([Author.name, Author.id])
+    ).fetchall())
+    book_slugs = set(s for s, in conn.execute(
+        Book.__table__.select().with_only_columns([Book.slug])))
+    topic_slugs = set(s for s, in conn.execute(
+        Topic.__table__.select().with_only_columns([Topic.slug])))
+    next_id = {}
+    for table in tables[:3]:
+        next_id[table] = (conn.execute(
+            table.select().with_only_columns([func.max(table.c.id)])
+        ).scalar() or 0) + 1
+
+    # Next slug suffixes of the batch, written to `slug_counter` with it
+    allocators = {Book: SlugAllocator(Book), Topic: SlugAllocator(Topic)}
+    slug_counts = {Book: {}, Topic: {}}
+
+    batch = {table: [] for table in tables}
+    books = rows = 0
+    started = time.time()
+
+    def flush() -> int:
+        """Insert and commit all collected rows, return number of rows."""
+        count = 0
+        book_rows = batch[Book.__table__]
+        with conn.begin():
+            for table in tables:
+                if batch[table]:
+                    conn.execute(table.insert(), batch[table])
+                    count += len(batch[table])
+                    batch[table] = []
+
+            if book_rows:
+                index_book_range(conn, book_rows[0]["id"],
+                                 book_rows[-1]["id"])
+                add_latest_book_range(conn, book_rows[0]["id"],
+                                      book_rows[-1]["id"])
+                add_facets(conn, select([Book.id]).where(Book.id.between(
+                    book_rows[0]["id"], book_rows[-1]["id"])))
+            for model, counts in slug_counts.items():
+                allocators[model].seed(conn, counts)
+                counts.clear()
+            bump_catalog_version(conn, [r["id"] for r in book_rows])
+        return count
+
+    def add_row(table: object, **values) -> int:
+        """Queue new row for `table` with the next free id, return id."""
+        values["id"] = next_id[table]
+        next_id[table] += 1
+        batch[table].append(values)
+        return values["id"]
+
+    def count_slug(model: object, slug: str, text: str) -> None:
+        """Remember the suffix of `slug` for the counter of `text`."""
+        base = create_slug(text)
+        count = 0 if slug == base else int(slug[len(base) + 1:])
+        counts = slug_counts[model]
+        counts[base] = max(counts.get(base, 0), count + 1)
+
+    with open(json_file, "r") as data_file:
+        for entry in iter_entries(data_file):
+            book_slug = get_slug(book_slugs, entry["title"])
+            book_slugs.add(book_slug)
+            count_slug(Book, book_slug, entry["title"])
+            book_id = add_row(
+                Book.__table__,
+                title=entry["title"],
+                isbn=entry["isbn"],
+                description=entry["description"],
+                slug=book_slug,
+                owner_id=owner_id,
+                pub_date=parse_pub_date(entry["publication_date"])
+            )
+
+            # Duplicates within one entry would violate the primary key,
+            # dropping them keeps the order of the entry for reproducible ids
+            for topic in OrderedDict.fromkeys(entry["topics"]):
+                if topic not in topic_ids:
+                    topic_slug = get_slug(topic_slugs, topic)
+                    topic_slugs.add(topic_slug)
+                    count_slug(Topic, topic_slug, topic)
+                    topic_ids[topic] = add_row(Topic.__table__, name=topic,
+                                               slug=topic_slug,
+                                               owner_id=owner_id)
+                batch[BookTopic.__table__].append(
+                    dict(book_id=book_id, topic_id=topic_ids[topic]))
+
+            for author in OrderedDict.fromkeys(entry["authors"]):
+                if author not in author_ids:
+                    author_ids[author] = add_row(Author.__table__,
+                                                 name=author)
+                batch[BookAuthor.__table__].append(
+                    dict(book_id=book_id, author_id=author_ids[author]))
+
+            books += 1
+            if books % batch_size == 0:
+                rows += flush()
+                if progress is not None:
+                    progress(books, rows, time.time() - started)
+
+    rows += flush()
+    if progress is not None:
+        progress(books, rows, time.time() - started)
+
+    # Scoring all books at once is cheaper than a refresh per batch
+    with conn.begin():
+        if related:
+            rebuild_related_books(conn)
+            clear_stale(conn)
+        else:
+            mark_stale(conn)
+
+    conn.close()
+    return books
+
+
 if __name__ == "__main__":
-    prepopulate_db()
+    parser = argparse.ArgumentParser(description="Prefill bookshelf.db.")
+    parser.add_argument("--bulk", action="store_true",
+                        help="stream entries and insert them in batches")
+    parser.add_argument("--batch-size", type=int, default=1000,
+                        help="entries per transaction in bulk mode")
+    parser.add_argument("--file", default=sys.path[0] + "/data/books.json",
+                        help="JSON array or NDJSON file to import in bulk "
+                             "mode")
+    parser.add_argument("--related", action="store_true",
+                        help="rebuild related books after a bulk import "
+                             "instead of marking them stale")
+    args = parser.parse_args()
+
+    if args.bulk:
+        bulk_import(args.file, batch_size=args.batch_size,
+                    related=args.related)
+    else:
+        prepopulate_db()
@@ -0,0 +1,179 @@
+"""Precomputed book counts per topic, author and publication year.
+
+Table `facet_count` holds one row `(kind, value, books)` per facet, where
+`kind` is "topic", "author" or "year" and `value` the topic id, author id or
+year. Pages and "/facets/JSON" read those counts with the names of topics
+and authors instead of aggregating the junction tables per request.
+
+Write paths keep counts in sync within their transaction: `remove_facets`
+subtracts the facets of books before they are changed or deleted and
+`add_facets` adds them again after books were added or changed. Only the
+changed books are aggregated, and facets without books are dropped. Edits
+that change single facets, like the authors of a book, apply their deltas
+with `adjust_facets` instead.
+"""
+from sqlalchemy import and_, bindparam, extract, func, select
+
+from db_bookshelf import Author, Book, BookAuthor, BookTopic, FacetCount, Topic
+
+KINDS = ["topic", "author", "year"]
+
+# Maximum number of ids per `IN` clause, SQLite allows 999 variables
+CHUNK_SIZE = 500
+
+
+def count_books(book_ids: object=None) -> dict:
+    """Return selects of `(value, books)` by kind, for `book_ids` or all
+    books.
+
+    Args:
+        book_ids: List of ids or select of ids
+    """
+    year = extract("year", Book.pub_date)
+    queries = {
+        "topic": select([BookTopic.topic_id, func.count()])
+        .group_by(BookTopic.topic_id),
+        "author": select([BookAuthor.author_id, func.count()])
+        .group_by(BookAuthor.author_id),
+        "year": select([year, func.count()]).group_by(year),
+    }
+
+    if book_ids is not None:
+        queries["topic"] = queries["topic"].where(
+            BookTopic.book_id.in_(book_ids))
+        queries["author"] = queries["author"].where(
+            BookAuthor.book_id.in_(book_ids))
+        queries["year"] = queries["year"].where(Book.id.in_(book_ids))
+
+    return queries
+
+
+def change_counts(bind: object, book_ids: object, sign: int) -> None:
+    """Add (`sign` 1) or subtract (`sign` -1) facets of `book_ids`."""
+    adjust_facets(bind, [(kind, value, books * sign)
+                         for kind, query in count_books(book_ids).items()
+                         for value, books in bind.execute(query)])
+
+
+def adjust_facets(bind: object, changes: list) -> None:
+    """Add deltas to the book counts of facets. Facets are created when
+    their count becomes positive and dropped when it drops to zero.
+
+    Args:
+        bind: Session or connection of the transaction that changed books
+        changes: List of tuples `(kind, value, delta)`
+    """
+    table = FacetCount.__table__
+    changes = [(k, v, d) for k, v, d in changes if d != 0]
+    if not changes:
+        return
+
+    existing = set()
+    for kind in KINDS:
+        values = [v for k, v, _ in changes if k == kind]
+        for i in range(0, len(values), CHUNK_SIZE):
+            chunk = values[i:i + CHUNK_SIZE]
+            existing.update((kind, v) for v, in bind.execute(
+                select([table.c.value])
+                .where(and_(table.c.kind == kind, table.c.value.in_(chunk)))
+            ))
+
+    updates = [dict(k=k, v=v, delta=d) for k, v, d in changes
+               if (k, v) in existing]
+    inserts = [dict(kind=k, value=v, books=d) for k, v, d in changes
+               if (k, v) not in existing and d > 0]
+
+    if updates:
+        bind.execute(
+            table.update()
+            .where(and_(table.c.kind == bindparam("k"),
+                        table.c.value == bindparam("v")))
+            .values(books=table.c.books + bindparam("delta")),
+            updates
+        )
+    if inserts:
+        bind.execute(table.insert(), inserts)
+
+    # Only decremented facets can drop to zero, skip scanning all others
+    for kind in KINDS:
+        values = [v for k, v, d in changes if k == kind and d < 0]
+        for i in range(0, len(values), CHUNK_SIZE):
+            chunk = values[i:i + CHUNK_SIZE]
+            bind.execute(table.delete().where(and_(
+                table.c.kind == kind, table.c.value.in_(chunk),
+                table.c.books <= 0)))
+
+
+def add_facets(bind: object, book_ids: object) -> None:
+    """Count books after they were added or changed. Pending ORM changes
+    must be flushed before.
+
+    Args:
+        bind: Session or connection of the transaction that changed books
+        book_ids: List of ids or select of ids
+    """
+    change_counts(bind, book_ids, 1)
+
+
+def remove_facets(bind: object, book_ids: object) -> None:
+    """Uncount books before they are changed or deleted.
+
+    Args:
+        bind: Session or connection of the transaction that changes books
+        book_ids: List of ids or select of ids
+    """
+    change_counts(bind, book_ids, -1)
+
+
+def remove_topic_facet(bind: object, topic_id: int) -> None:
+    """Drop the facet of a deleted topic."""
+    table = FacetCount.__table__
+    bind.execute(table.delete().where(and_(table.c.kind == "topic",
+                                           table.c.value == topic_id)))
+
+
+def rebuild_facets(bind: object) -> None:
+    """Replace all rows with counts of all books."""
+    table = FacetCount.__table__
+    bind.execute(table.delete())
+    for kind, query in count_books().items():
+        rows = [dict(kind=kind, value=value, books=books)
+                for value, books in bind.execute(query)]
+        if rows:
+            bind.execute(table.insert(), rows)
+
+
+def select_facets(bind: object, max_authors: int=None) -> dict:
+    """Return facets with book counts by kind.
+
+    Returns:
+        Dictionary with lists of dictionaries: `topics` with `name`, `slug`
+        and `books` ordered by topic id, `authors` with `name` and `books`
+        ordered by `books` descending and name, and `years` with `year` and
+        `books` newest first. `max_authors` limits the authors.
+    """
+    table = FacetCount.__table__
+    topics = (
+        select([Topic.name, Topic.slug, func.coalesce(table.c.books, 0)])
+        .select_from(Topic.__table__.outerjoin(table, and_(
+            table.c.kind == "topic", table.c.value == Topic.id)))
+        .order_by(Topic.id)
+    )
+    authors = (
+        select([Author.name, table.c.books])
+        .where(and_(table.c.kind == "author", table.c.value == Author.id))
+        .order_by(table.c.books.desc(), Author.name)
+        .limit(max_authors)
+    )
+    years = (
+        select([table.c.value, table.c.books])
+        .where(table.c.kind == "year")
+        .order_by(table.c.value.desc())
+    )
+
+    return {
+        "topics": [dict(name=n, slug=s, books=b)
+                   for n, s, b in bind.execute(topics)],
+        "authors": [dict(name=n, books=b) for n, b in bind.execute(authors)],
+        "years": [dict(year=y, books=b) for y, b in bind.execute(years)],
+    }
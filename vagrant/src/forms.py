@@ -1,7 +1,39 @@
+from datetime import date
+
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, TextAreaField, validators
 
 
+class NameList:
+    """Validator for comma separated names, requires at least one name that
+    isn't blank, e.g. rejects ", ,". Stops the validation chain of the field.
+    """
+    def __init__(self, message: str):
+        self.message = message
+
+    def __call__(self, form: FlaskForm, field: StringField):
+        if not any(name.strip() for name in (field.data or "").split(",")):
+            raise validators.StopValidation(self.message)
+
+
+class MonthYear:
+    """Validator for dates in format MM-YYYY, requires an existing month,
+    e.g. rejects 13-2019 or 01-0000. Skipped if earlier validators of the
+    field failed, so a wrong format is reported once.
+    """
+    def __init__(self, message: str):
+        self.message = message
+
+    def __call__(self, form: FlaskForm, field: StringField):
+        if field.errors:
+            return
+        try:
+            month, year = field.data.split("-")
+            date(int(year), int(month), 1)
+        except ValueError:
+            raise validators.ValidationError(self.message)
+
+
 class UpdateTopicForm(FlaskForm):
     """Form for route "<topic_slug>/edit". """
     name = StringField(
@@ -34,7 +66,8 @@ class UpdateBookForm(FlaskForm):
     )
     authors = StringField(
         "Author(s):",
-        [validators.Length(min=3, max=250,
+        [NameList(message="List authors, separated by comma."),
+         validators.Length(min=3, max=250,
                            message="List authors, separated by comma.")]
     )
     pub_date = StringField(
@@ -43,7 +76,9 @@ class UpdateBookForm(FlaskForm):
                            message="Must be 7 characters long."),
          validators.Regexp("^\d\d-\d\d\d\d$",
                            message="Publication date must be in format "
-                                   "MM-YYYY, like 06-2010 for June 2010.")]
+                                   "MM-YYYY, like 06-2010 for June 2010."),
+         MonthYear(message="Publication date must be an existing month, "
+                           "like 06-2010 for June 2010.")]
     )
     description = TextAreaField("Description:", [validators.Optional()])
     submit = SubmitField("Submit")
@@ -59,12 +94,14 @@ class AddBookForm(FlaskForm):
     )
     authors = StringField(
         "Author(s):",
-        [validators.Length(min=3, max=250,
+        [NameList(message="List authors, separated by comma."),
+         validators.Length(min=3, max=250,
                            message="List authors, separated by comma.")]
     )
     topics = StringField(
         "Topic(s):",
-        [validators.Length(min=3, max=250,
+        [NameList(message="List topics, separated by comma."),
+         validators.Length(min=3, max=250,
                            message="List topics, separated by comma.")]
     )
     isbn = StringField(
@@ -79,7 +116,9 @@ class AddBookForm(FlaskForm):
                            message="Must be 7 characters long."),
          validators.Regexp("^\d\d-\d\d\d\d$",
                            message="Publication date must be in format "
-                                   "MM-YYYY, like 06-2010 for June 2010.")]
+                                   "MM-YYYY, like 06-2010 for June 2010."),
+         MonthYear(message="Publication date must be an existing month, "
+                           "like 06-2010 for June 2010.")]
     )
     description = TextAreaField("Description:", [validators.Optional()])
     submit = SubmitField("Submit")
@@ -0,0 +1,130 @@
+"""Read models for the overview pages, newest books first.
+
+Table `latest_book` holds one row `(pub_date, title, book slug, topic slug)`
+per book, where the topic slug is the one of the book's canonical topic, the
+topic with the lowest id. Pages of "/" are a range scan on index
+`(pub_date, book_id)` instead of a join with an aggregate per book.
+
+Table `topic_book` holds one row `(topic_id, pub_date, title, book slug)`
+per book and topic. Pages of "/<topic_slug>" are a range scan on index
+`(topic_id, pub_date, book_id)` instead of sorting all books of the topic.
+
+Write paths call `refresh_latest_books` with the ids of changed books in the
+same transaction, so the read models are always in sync with the catalog.
+Besides changed books, rows of `latest_book` must be refreshed when the slug
+of their canonical topic changes or their canonical topic is deleted, and
+rows of `topic_book` removed when their topic is deleted.
+"""
+from sqlalchemy import and_, select
+
+from db_bookshelf import Book, BookTopic, LatestBook, Topic, TopicBook
+
+# Maximum number of ids per `IN` clause, SQLite allows 999 variables
+CHUNK_SIZE = 500
+
+
+def latest_book_rows() -> object:
+    """Return select of rows `(book_id, pub_date, title, book_slug,
+    topic_slug)` for `latest_book`.
+    """
+    topic_slug = (
+        select([Topic.slug])
+        .where(and_(BookTopic.book_id == Book.id,
+                    BookTopic.topic_id == Topic.id))
+        .order_by(BookTopic.topic_id)
+        .limit(1)
+        .as_scalar()
+    )
+    return select([Book.id, Book.pub_date, Book.title, Book.slug,
+                   topic_slug])
+
+
+def topic_book_rows() -> object:
+    """Return select of rows `(topic_id, book_id, pub_date, title,
+    book_slug)` for `topic_book`.
+    """
+    return (
+        select([BookTopic.topic_id, Book.id, Book.pub_date, Book.title,
+                Book.slug])
+        .select_from(BookTopic.__table__.join(
+            Book, Book.id == BookTopic.book_id))
+    )
+
+
+def insert_latest_books(bind: object, where: object) -> None:
+    """Insert rows for all books matching `where` clause on `Book`."""
+    bind.execute(LatestBook.__table__.insert().from_select(
+        [c.name for c in LatestBook.__table__.columns],
+        latest_book_rows().where(where)
+    ))
+    bind.execute(TopicBook.__table__.insert().from_select(
+        [c.name for c in TopicBook.__table__.columns],
+        topic_book_rows().where(where)
+    ))
+
+
+def refresh_latest_books(bind: object, book_ids: list) -> None:
+    """Replace rows of `book_ids` after they were added, changed or deleted.
+    Pending ORM changes must be flushed before.
+
+    Args:
+        bind: Session or connection of the transaction that changed books
+        book_ids: Ids of changed books, including deleted ones
+    """
+    book_ids = list(book_ids)
+
+    for i in range(0, len(book_ids), CHUNK_SIZE):
+        chunk = book_ids[i:i + CHUNK_SIZE]
+        for table in (LatestBook.__table__, TopicBook.__table__):
+            bind.execute(table.delete().where(table.c.book_id.in_(chunk)))
+        insert_latest_books(bind, Book.id.in_(chunk))
+
+
+def select_book_ids_by_topic_slug(bind: object, topic_slug: str) -> list:
+    """Return ids of books whose canonical topic has `topic_slug`, i.e. the
+    rows to refresh after that topic was renamed or deleted.
+    """
+    table = LatestBook.__table__
+    return [i for i, in bind.execute(
+        select([table.c.book_id]).where(table.c.topic_slug == topic_slug)
+    )]
+
+
+def remove_latest_books(bind: object, book_ids: object) -> None:
+    """Remove rows of deleted books with a single statement.
+
+    Args:
+        bind: Session or connection of the transaction that deletes books
+        book_ids: List of ids or select of ids
+    """
+    for table in (LatestBook.__table__, TopicBook.__table__):
+        bind.execute(table.delete().where(table.c.book_id.in_(book_ids)))
+
+
+def remove_topic_books(bind: object, topic_id: int) -> None:
+    """Remove rows of a topic before it is deleted."""
+    table = TopicBook.__table__
+    bind.execute(table.delete().where(table.c.topic_id == topic_id))
+
+
+def add_latest_book_range(bind: object, first_id: int, last_id: int) -> None:
+    """Add rows of new books with ids from `first_id` to `last_id`, e.g.
+    after a batch of `db_prefill.bulk_import`.
+    """
+    insert_latest_books(bind, Book.id.between(first_id, last_id))
+
+
+def rebuild_latest_books(bind: object) -> None:
+    """Replace all rows of `latest_book` with rows for all books."""
+    bind.execute(LatestBook.__table__.delete())
+    bind.execute(LatestBook.__table__.insert().from_select(
+        [c.name for c in LatestBook.__table__.columns], latest_book_rows()
+    ))
+
+
+def rebuild_topic_books(bind: object) -> None:
+    """Replace all rows of `topic_book` with rows for all books."""
+    bind.execute(TopicBook.__table__.delete())
+    bind.execute(TopicBook.__table__.insert().from_select(
+        [c.name for c in TopicBook.__table__.columns], topic_book_rows()
+    ))
@@ -0,0 +1,140 @@
+"""Per-endpoint request and SQL metrics in Prometheus text format.
+
+`instrument_engine` times every statement executed by an engine and hands
+the duration to a callback, which attributes it to the current request.
+`RequestMetrics` aggregates requests, latency histograms, query counts and
+SQL time per Flask endpoint and renders them for route "/metrics".
+
+Metrics are kept in memory of the process that handled the request, so with
+several worker processes each scrape only sees the worker it hits.
+"""
+import threading
+import time
+
+from sqlalchemy import event
+
+# Upper bounds in seconds of the request latency histogram
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+def instrument_engine(engine: object, on_query: object) -> None:
+    """Call `on_query(seconds)` after each statement executed by `engine`."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_timer(conn, cursor, statement, parameters, context,
+                    executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def stop_timer(conn, cursor, statement, parameters, context,
+                   executemany):
+        on_query(time.perf_counter() - conn.info["query_started"].pop())
+
+
+def format_labels(labels: tuple) -> str:
+    """Return Prometheus label set for tuple of `(name, value)` pairs."""
+    return "{" + ",".join('{}="{}"'.format(
+        name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels) + "}"
+
+
+class RequestMetrics:
+    """Thread-safe counters and latency histograms per endpoint.
+
+    Example:
+        metrics.observe("overview", "GET", 200, 0.012, 3, 0.002)
+        Records one request of endpoint "overview" that took 12 ms and ran 3
+        queries with 2 ms SQL time in total.
+    """
+
+    def __init__(self, buckets: tuple=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.latency = {}
+        self.queries = {}
+        self.sql_seconds = {}
+
+    def observe(self, endpoint: str, method: str, status: int,
+                seconds: float, queries: int, sql_seconds: float) -> None:
+        """Record one finished request."""
+        key = (endpoint, method, status)
+
+        with self.lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+            # Bucket counts are stored per bucket and summed up on render
+            histogram = self.latency.get(endpoint)
+            if histogram is None:
+                histogram = self.latency[endpoint] = [
+                    [0] * (len(self.buckets) + 1), 0.0]
+            index = len(self.buckets)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    index = i
+                    break
+            histogram[0][index] += 1
+            histogram[1] += seconds
+
+            self.queries[endpoint] = self.queries.get(endpoint, 0) + queries
+            self.sql_seconds[endpoint] = (self.sql_seconds.get(endpoint, 0.0)
+                                          + sql_seconds)
+
+    def render(self) -> str:
+        """Return all metrics in Prometheus text exposition format."""
+        lines = []
+
+        with self.lock:
+            lines.append("# HELP bookshelf_requests_total Handled requests.")
+            lines.append("# TYPE bookshelf_requests_total counter")
+            for (endpoint, method, status), count in sorted(
+                    self.requests.items()):
+                lines.append("bookshelf_requests_total{} {}".format(
+                    format_labels((("endpoint", endpoint), ("method", method),
+                                   ("status", status))), count))
+
+            lines.append("# HELP bookshelf_request_duration_seconds Request "
+                         "latency.")
+            lines.append("# TYPE bookshelf_request_duration_seconds "
+                         "histogram")
+            for endpoint, (counts, total) in sorted(self.latency.items()):
+                cumulative = 0
+                bounds = [str(b) for b in self.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, counts):
+                    cumulative += count
+                    lines.append(
+                        "bookshelf_request_duration_seconds_bucket{} {}"
+                        .format(format_labels((("endpoint", endpoint),
+                                               ("le", bound))), cumulative))
+                labels = format_labels((("endpoint", endpoint),))
+                lines.append("bookshelf_request_duration_seconds_sum{} {}"
+                             .format(labels, repr(total)))
+                lines.append("bookshelf_request_duration_seconds_count{} {}"
+                             .format(labels, cumulative))
+
+            lines.append("# HELP bookshelf_sql_queries_total SQL statements "
+                         "executed by requests.")
+            lines.append("# TYPE bookshelf_sql_queries_total counter")
+            for endpoint, count in sorted(self.queries.items()):
+                lines.append("bookshelf_sql_queries_total{} {}".format(
+                    format_labels((("endpoint", endpoint),)), count))
+
+            lines.append("# HELP bookshelf_sql_duration_seconds_total Time "
+                         "spent in SQL statements by requests.")
+            lines.append("# TYPE bookshelf_sql_duration_seconds_total "
+                         "counter")
+            for endpoint, total in sorted(self.sql_seconds.items()):
+                lines.append("bookshelf_sql_duration_seconds_total{} {}"
+                             .format(format_labels((("endpoint", endpoint),)),
+                                     repr(total)))
+
+        return "\n".join(lines) + "\n"
+
+    def clear(self) -> None:
+        """Reset all metrics."""
+        with self.lock:
+            self.requests.clear()
+            self.latency.clear()
+            self.queries.clear()
+            self.sql_seconds.clear()
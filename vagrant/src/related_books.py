@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+
+"""Related books, precomputed from shared topics and authors.
+
+The score of two books is the number of topics they share plus
+`AUTHOR_WEIGHT` times the number of authors they share. Table
+`related_book` holds the `RELATED_BOOKS` best scored books of each book,
+ranked by score and then id, so a detail page reads them by primary key.
+Topics and authors of more than `MAX_POSTINGS` books, counted by
+`facet_count`, are skipped: they are too common to tell books apart, and the
+cost of scoring a book would grow with the catalog.
+
+`rebuild_related_books` scores all books at once as the sparse product of
+the book-feature matrix with its transpose. It uses numpy and scipy if they
+are installed, otherwise an inverted index in pure Python; both rank
+alike.
+
+Write paths call `refresh_related_books` with the ids of changed books in
+the same transaction. It recomputes the lists of changed books and of books
+whose lists contain them, and merges changed books into all other lists
+they now rank in. If that means recomputing more than
+`MAX_REFRESHED_LISTS` lists, e.g. after deleting a large topic, all lists
+are marked stale in `related_book_stale` instead. So are they if a topic or
+author crossed `MAX_POSTINGS` since the skipped ones were saved in
+`related_common_feature` by `clear_stale`. Requests never rebuild, run this
+module to rebuild stale lists:
+
+    python3 related_books.py [--force]
+"""
+import argparse
+import heapq
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import and_, select
+
+from db_bookshelf import (
+    Book, BookAuthor, BookTopic, FacetCount, LatestBook, RelatedBook,
+    RelatedBookStale, RelatedCommonFeature, engine
+)
+
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:
+    numpy = sparse = None
+
+# Number of related books per book
+RELATED_BOOKS = 5
+
+# Shared authors weigh more than shared topics
+TOPIC_WEIGHT = 1
+AUTHOR_WEIGHT = 3
+
+# Maximum number of ids per `IN` clause, SQLite allows 999 variables
+CHUNK_SIZE = 500
+
+# Features of more books are skipped when scoring
+MAX_POSTINGS = 1000
+
+# Mark all lists stale if a write affects more lists than this
+MAX_REFRESHED_LISTS = 100
+
+# Id of the single row of `related_book_stale`
+STALE_ID = 1
+
+# Rows of the score matrix computed at once by `rebuild_related_books`
+ROW_CHUNK_SIZE = 1000
+
+# Features of books, each with its kind in `facet_count` and its weight
+FEATURES = [(BookTopic.__table__, "topic_id", "topic", TOPIC_WEIGHT),
+            (BookAuthor.__table__, "author_id", "author", AUTHOR_WEIGHT)]
+
+# Related book with link to its canonical topic, as in `latest_book`
+RelatedLink = namedtuple("RelatedLink", ["title", "slug", "topic_slug",
+                                         "score"])
+
+
+def chunks(ids: object) -> list:
+    """Return `ids` in lists of at most `CHUNK_SIZE`."""
+    ids = list(ids)
+    return [ids[i:i + CHUNK_SIZE] for i in range(0, len(ids), CHUNK_SIZE)]
+
+
+def top_related(scores: dict) -> list:
+    """Return best `RELATED_BOOKS` tuples `(related_id, score)` of `scores`,
+    a dict of related id -> score.
+    """
+    return heapq.nsmallest(RELATED_BOOKS, scores.items(),
+                           key=lambda item: (-item[1], item[0]))
+
+
+def create_rows(book_id: int, related: list) -> list:
+    """Return rows of `related_book` for `related` of `top_related`."""
+    return [dict(book_id=book_id, rank=rank, related_id=related_id,
+                 score=score)
+            for rank, (related_id, score) in enumerate(related)]
+
+
+def load_common(bind: object) -> set:
+    """Return set of features `(column, value)` of more than `MAX_POSTINGS`
+    books, a range scan on index `(kind, books)` of `facet_count`.
+    """
+    facets = FacetCount.__table__
+    common = set()
+    for _, feature, kind, _ in FEATURES:
+        common.update((feature, value) for value, in bind.execute(
+            select([facets.c.value])
+            .where(and_(facets.c.kind == kind,
+                        facets.c.books > MAX_POSTINGS))
+        ))
+    return common
+
+
+def load_saved_common(bind: object) -> set:
+    """Return set of features `(column, value)` saved by `clear_stale`."""
+    table = RelatedCommonFeature.__table__
+    return set((feature, value) for feature, value in bind.execute(
+        select([table.c.feature, table.c.value])))
+
+
+def score_books(bind: object, book_ids: list, common: set) -> dict:
+    """Return dict of book id -> dict of related id -> score for each of
+    `book_ids`, scored against all other books.
+
+    Only the postings of features of `book_ids` are fetched, i.e. the books
+    that have them, except for `common` features of `load_common`. Scores
+    are summed up here rather than by a self join, which would return one
+    row per pair of books.
+    """
+    scores = dict((book_id, {}) for book_id in book_ids)
+
+    for table, feature, _, weight in FEATURES:
+        owners = {}
+        for chunk in chunks(book_ids):
+            for book_id, value in bind.execute(
+                select([table.c.book_id, table.c[feature]])
+                .where(table.c.book_id.in_(chunk))
+            ):
+                if (feature, value) not in common:
+                    owners.setdefault(value, []).append(book_id)
+
+        for chunk in chunks(owners):
+            for related_id, value in bind.execute(
+                select([table.c.book_id, table.c[feature]])
+                .where(table.c[feature].in_(chunk))
+            ):
+                for book_id in owners[value]:
+                    if book_id != related_id:
+                        related = scores[book_id]
+                        related[related_id] = \
+                            related.get(related_id, 0) + weight
+
+    return scores
+
+
+def load_lists(bind: object, book_ids: object) -> dict:
+    """Return dict of book id -> current list `(related_id, score)`."""
+    table = RelatedBook.__table__
+    lists = {}
+    for chunk in chunks(book_ids):
+        for book_id, related_id, score in bind.execute(
+            select([table.c.book_id, table.c.related_id, table.c.score])
+            .where(table.c.book_id.in_(chunk))
+            .order_by(table.c.book_id, table.c.rank)
+        ):
+            lists.setdefault(book_id, []).append((related_id, score))
+    return lists
+
+
+def refresh_related_books(bind: object, book_ids: list,
+                          is_removal: bool=False) -> None:
+    """Update related books after `book_ids` were added, changed or
+    deleted, or mark all lists stale if more than `MAX_REFRESHED_LISTS`
+    lists are affected. Pending ORM changes must be flushed before.
+
+    Args:
+        bind: Session or connection of the transaction that changed books
+        book_ids: Ids of changed books, including deleted ones
+        is_removal: Books were only deleted or lost topics or authors, so
+            they can't rank higher in other lists than before
+    """
+    table = RelatedBook.__table__
+    book_ids = set(book_ids)
+    if len(book_ids) > MAX_REFRESHED_LISTS:
+        mark_stale(bind)
+        return
+
+    # A topic or author crossed `MAX_POSTINGS`, the lists of its books are
+    # scored with or without it, but should be the other way round
+    common = load_common(bind)
+    if common != load_saved_common(bind):
+        mark_stale(bind)
+
+    existing = set()
+    for chunk in chunks(book_ids):
+        existing.update(i for i, in bind.execute(
+            select([Book.id]).where(Book.id.in_(chunk))))
+    scores = score_books(bind, sorted(existing), common)
+
+    # Lists in which a changed book lost score may rank another book higher
+    # now, lists in which it kept or gained score are merged below
+    recompute = set(existing)
+    for chunk in chunks(book_ids):
+        for book_id, related_id, score in bind.execute(
+            select([table.c.book_id, table.c.related_id, table.c.score])
+            .where(table.c.related_id.in_(chunk))
+        ):
+            if book_id not in book_ids and \
+                    scores.get(related_id, {}).get(book_id, 0) < score:
+                recompute.add(book_id)
+
+    if len(recompute) > MAX_REFRESHED_LISTS:
+        mark_stale(bind)
+        return
+
+    scores.update(score_books(bind, sorted(recompute - existing), common))
+    rows = []
+    for book_id in recompute:
+        rows.extend(create_rows(book_id, top_related(scores[book_id])))
+
+    # Other lists may rank changed books higher now, scores are symmetric
+    candidates = {}
+    for book_id in existing if not is_removal else ():
+        for related_id, score in scores[book_id].items():
+            if related_id not in recompute:
+                candidates.setdefault(related_id, {})[book_id] = score
+
+    lists = load_lists(bind, candidates)
+    for book_id, new_scores in candidates.items():
+        current = lists.get(book_id, [])
+        merged = top_related(dict(current + list(new_scores.items())))
+        if merged != current:
+            recompute.add(book_id)
+            rows.extend(create_rows(book_id, merged))
+
+    for chunk in chunks(book_ids | recompute):
+        bind.execute(table.delete().where(table.c.book_id.in_(chunk)))
+    if rows:
+        bind.execute(table.insert(), rows)
+
+
+def load_features(bind: object) -> object:
+    """Yield rows `(book_id, feature, weight)` of all books, where features
+    are tuples `(column, value)`. Features of `load_common` are skipped, as
+    by `score_books`.
+    """
+    common = load_common(bind)
+    for table, feature, _, weight in FEATURES:
+        for book_id, value in bind.execute(
+            select([table.c.book_id, table.c[feature]])
+        ):
+            if (feature, value) not in common:
+                yield book_id, (feature, value), weight
+
+
+def score_all_python(features: object) -> object:
+    """Yield tuples `(book_id, related)` of all books with `top_related`,
+    scored with an inverted index of features.
+    """
+    books = {}
+    postings = {}
+    for book_id, feature, weight in features:
+        books.setdefault(book_id, []).append((feature, weight))
+        postings.setdefault(feature, []).append(book_id)
+
+    for book_id, book_features in books.items():
+        scores = {}
+        for feature, weight in book_features:
+            for related_id in postings[feature]:
+                scores[related_id] = scores.get(related_id, 0) + weight
+        del scores[book_id]
+        yield book_id, top_related(scores)
+
+
+def score_all_sparse(features: object) -> object:
+    """Yield tuples `(book_id, related)` of all books with `top_related`,
+    scored as sparse product of weighted and binary book-feature matrix.
+    """
+    book_ids = []
+    book_index = {}
+    feature_index = {}
+    rows, columns, weights = [], [], []
+    for book_id, feature, weight in features:
+        if book_id not in book_index:
+            book_index[book_id] = len(book_ids)
+            book_ids.append(book_id)
+        rows.append(book_index[book_id])
+        columns.append(feature_index.setdefault(feature, len(feature_index)))
+        weights.append(weight)
+
+    shape = (len(book_ids), len(feature_index))
+    weighted = sparse.csr_matrix((weights, (rows, columns)), shape=shape)
+    binary = sparse.csr_matrix(([1] * len(rows), (rows, columns)),
+                               shape=shape).transpose().tocsc()
+    ids = numpy.array(book_ids)
+
+    for start in range(0, len(book_ids), ROW_CHUNK_SIZE):
+        scores = weighted[start:start + ROW_CHUNK_SIZE].dot(binary).tocsr()
+        for offset in range(scores.shape[0]):
+            row = start + offset
+            first, last = scores.indptr[offset], scores.indptr[offset + 1]
+            related = ids[scores.indices[first:last]]
+            score = scores.data[first:last]
+            is_other = related != book_ids[row]
+            related, score = related[is_other], score[is_other]
+
+            # Order by score descending, then id, as `top_related`
+            best = numpy.lexsort((related, -score))[:RELATED_BOOKS]
+            yield book_ids[row], [(int(related[i]), int(score[i]))
+                                  for i in best]
+
+
+def rebuild_related_books(bind: object) -> None:
+    """Replace all rows with related books of all books. Call `clear_stale`
+    afterwards, unless its tables don't exist yet.
+    """
+    table = RelatedBook.__table__
+    score_all = score_all_sparse if sparse is not None else score_all_python
+
+    bind.execute(table.delete())
+    rows = []
+    for book_id, related in score_all(load_features(bind)):
+        rows.extend(create_rows(book_id, related))
+        if len(rows) >= CHUNK_SIZE:
+            bind.execute(table.insert(), rows)
+            rows = []
+    if rows:
+        bind.execute(table.insert(), rows)
+
+
+def mark_stale(bind: object) -> None:
+    """Mark all lists as outdated until the next `rebuild_related_books`."""
+    table = RelatedBookStale.__table__
+    if not is_stale(bind):
+        bind.execute(table.insert().values(id=STALE_ID,
+                                           marked_at=datetime.utcnow()))
+
+
+def clear_stale(bind: object) -> None:
+    """Remove the mark of `mark_stale` after `rebuild_related_books` and
+    save the features it skipped.
+    """
+    table = RelatedCommonFeature.__table__
+    bind.execute(RelatedBookStale.__table__.delete())
+    bind.execute(table.delete())
+    rows = [dict(feature=feature, value=value)
+            for feature, value in load_common(bind)]
+    if rows:
+        bind.execute(table.insert(), rows)
+
+
+def is_stale(bind: object) -> bool:
+    """Return `True` if lists were marked by `mark_stale`."""
+    table = RelatedBookStale.__table__
+    return bind.execute(select([table.c.id])).first() is not None
+
+
+def select_related_books(bind: object, book_id: int) -> list:
+    """Return list of `RelatedLink` of `book_id`, best first."""
+    table = RelatedBook.__table__
+    return [RelatedLink(*row) for row in bind.execute(
+        select([LatestBook.title, LatestBook.book_slug, LatestBook.topic_slug,
+                table.c.score])
+        .select_from(table.join(LatestBook,
+                                LatestBook.book_id == table.c.related_id))
+        .where(table.c.book_id == book_id)
+        .order_by(table.c.rank)
+    )]
+
+
+def select_related_ids(bind: object, book_id: int) -> list:
+    """Return list of tuples `(related_id, score)` of `book_id`, best
+    first.
+    """
+    table = RelatedBook.__table__
+    return [tuple(row) for row in bind.execute(
+        select([table.c.related_id, table.c.score])
+        .where(table.c.book_id == book_id)
+        .order_by(table.c.rank)
+    )]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild related books.")
+    parser.add_argument("--force", action="store_true",
+                        help="rebuild even if lists aren't marked stale")
+    args = parser.parse_args()
+
+    with engine.begin() as connection:
+        if args.force or is_stale(connection):
+            rebuild_related_books(connection)
+            clear_stale(connection)
+            print("Rebuilt related books")
+        else:
+            print("Related books are up to date")
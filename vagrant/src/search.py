@@ -0,0 +1,155 @@
+"""Full-text search over titles, descriptions and author names of books.
+
+On SQLite with FTS5, books are indexed in the FTS5 table `book_fts` (see
+`db_bookshelf.BOOK_FTS_DDL`) and results are ranked with bm25. Write paths
+call `index_books` with the ids of changed books in the same transaction, so
+the index is always in sync with the catalog.
+
+Other databases and SQLite builds without FTS5 have no `book_fts` table.
+There, `index_books` does nothing and `search_books` falls back to a `LIKE`
+query on titles.
+"""
+import re
+
+from sqlalchemy import and_, func, literal_column, select, text
+
+from db_bookshelf import (
+    Author, Book, BookAuthor, BookTopic, Topic, book_fts, has_fts5
+)
+
+# Weights of columns title, description and authors for bm25
+BM25_WEIGHTS = (10.0, 1.0, 5.0)
+
+# Maximum number of ids per `IN` clause, SQLite allows 999 variables
+CHUNK_SIZE = 500
+
+regex_token = re.compile(r"\w+", re.UNICODE)
+
+
+def has_index(bind: object) -> bool:
+    """Return whether `bind` (session or connection) supports `book_fts`."""
+    return has_fts5(bind)
+
+
+def index_rows() -> object:
+    """Return select of rows `(id, title, description, authors)` for
+    `book_fts`, where authors are the author names joined by spaces.
+    """
+    authors = (
+        select([func.group_concat(Author.name, " ")])
+        .where(and_(BookAuthor.book_id == Book.id,
+                    BookAuthor.author_id == Author.id))
+        .as_scalar()
+    )
+    return select([Book.id, Book.title, Book.description, authors])
+
+
+def index_books(bind: object, book_ids: list) -> None:
+    """Update index entries of `book_ids` after they were added, changed or
+    deleted. Pending ORM changes must be flushed before.
+
+    Args:
+        bind: Session or connection of the transaction that changed books
+        book_ids: Ids of changed books, including deleted ones
+    """
+    if not has_index(bind):
+        return
+
+    book_ids = list(book_ids)
+    for i in range(0, len(book_ids), CHUNK_SIZE):
+        chunk = book_ids[i:i + CHUNK_SIZE]
+        bind.execute(book_fts.delete().where(book_fts.c.rowid.in_(chunk)))
+        bind.execute(book_fts.insert().from_select(
+            [c.name for c in book_fts.columns],
+            index_rows().where(Book.id.in_(chunk))
+        ))
+
+
+def remove_books(bind: object, book_ids: object) -> None:
+    """Remove index entries of deleted books with a single statement.
+
+    Args:
+        bind: Session or connection of the transaction that deletes books
+        book_ids: List of ids or select of ids
+    """
+    if has_index(bind):
+        bind.execute(book_fts.delete().where(book_fts.c.rowid.in_(book_ids)))
+
+
+def index_book_range(bind: object, first_id: int, last_id: int) -> None:
+    """Add index entries of new books with ids from `first_id` to
+    `last_id`, e.g. after a batch of `db_prefill.bulk_import`.
+    """
+    if not has_index(bind):
+        return
+
+    bind.execute(book_fts.insert().from_select(
+        [c.name for c in book_fts.columns],
+        index_rows().where(Book.id.between(first_id, last_id))
+    ))
+
+
+def rebuild_index(bind: object) -> None:
+    """Replace all index entries with entries for all books."""
+    if not has_index(bind):
+        return
+
+    bind.execute(book_fts.delete())
+    bind.execute(book_fts.insert().from_select(
+        [c.name for c in book_fts.columns], index_rows()
+    ))
+
+
+def create_match_query(text_query: str) -> str:
+    """Return FTS5 query that matches all words of `text_query` as prefixes.
+
+    User input is never passed to FTS5 as is, since operators like `AND`,
+    `NEAR` or unbalanced quotes would be syntax errors.
+
+    Example:
+        Learn pyth -> "learn"* "pyth"*
+    """
+    return " ".join('"{}"*'.format(t) for t in
+                    regex_token.findall(text_query.lower()))
+
+
+def search_books(bind: object, text_query: str, limit: int=50) -> list:
+    """Return books matching all words of `text_query`, best matches first.
+
+    Returns:
+        List of rows `(title, slug, topic_slug, pub_date, id)`, where
+        `topic_slug` is the slug of one topic of the book for its URL.
+    """
+    match_query = create_match_query(text_query)
+    if not match_query:
+        return []
+
+    topic_slug = (
+        select([Topic.slug])
+        .where(and_(BookTopic.book_id == Book.id,
+                    BookTopic.topic_id == Topic.id))
+        .order_by(BookTopic.topic_id)
+        .limit(1)
+        .as_scalar()
+    )
+    columns = [Book.title, Book.slug, topic_slug.label("topic_slug"),
+               Book.pub_date, Book.id]
+
+    if has_index(bind):
+        rank = text("bm25(book_fts, {}, {}, {})".format(*BM25_WEIGHTS))
+        query = (
+            select(columns)
+            .select_from(book_fts.join(Book, Book.id == book_fts.c.rowid))
+            .where(literal_column("book_fts").match(match_query))
+            .order_by(rank)
+        )
+    else:
+        words = regex_token.findall(text_query)
+        query = (
+            select(columns)
+            .where(and_(*[Book.title.ilike("%{}%".format(w))
+                          for w in words]))
+            .order_by(Book.pub_date.desc())
+        )
+
+    return bind.execute(query.limit(limit)).fetchall()
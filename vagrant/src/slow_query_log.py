@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+"""Log statements slower than a threshold, and summarize the log.
+
+`install_slow_query_log` times every statement executed by an engine. Each
+statement that takes at least `threshold_ms` is appended to the log file as
+one JSON object per line, with its bound parameters, the route that issued it
+and, on SQLite, the output of `EXPLAIN QUERY PLAN`.
+
+Run this module to summarize a log by statement fingerprint, i.e. the
+statement with literals and parameter lists collapsed:
+
+    python3 slow_query_log.py slow_queries.log --top 10
+"""
+import argparse
+import json
+import logging
+import re
+import sys
+import time
+from datetime import datetime
+
+from sqlalchemy import event
+
+LOGGER_NAME = "bookshelf.slow_queries"
+
+# Those patterns are collapsed to create a statement fingerprint
+regex_whitespace = re.compile(r"\s+")
+regex_string = re.compile(r"'(?:[^']|'')*'")
+regex_number = re.compile(r"\b\d+(?:\.\d+)?\b")
+regex_placeholders = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+
+
+def create_fingerprint(statement: str) -> str:
+    """Return `statement` with literals replaced by "?" and lists of
+    parameters collapsed to "(...)".
+
+    Example:
+        SELECT * FROM book WHERE id IN (?, ?, ?) LIMIT 20 ->
+        SELECT * FROM book WHERE id IN (...) LIMIT ?
+    """
+    fingerprint = regex_whitespace.sub(" ", statement).strip()
+    fingerprint = regex_string.sub("?", fingerprint)
+    fingerprint = regex_number.sub("?", fingerprint)
+    return regex_placeholders.sub("(...)", fingerprint)
+
+
+def explain_query_plan(conn: object, statement: str,
+                       parameters: object) -> list:
+    """Return lines of `EXPLAIN QUERY PLAN` for `statement` on SQLite.
+
+    The plan is read from a raw cursor on the same connection, so it is not
+    timed itself. Returns `None` on other databases or if the statement can
+    not be explained.
+    """
+    if conn.dialect.name != "sqlite":
+        return None
+
+    try:
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+            return [row[-1] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+    except conn.dialect.dbapi.Error:
+        return None
+
+
+def create_logger(log_path: str) -> logging.Logger:
+    """Return logger that appends messages to `log_path`, or stderr if
+    `log_path` is `None`.
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(logging.WARNING)
+    logger.propagate = False
+
+    if not logger.handlers:
+        if log_path is None:
+            handler = logging.StreamHandler()
+        else:
+            handler = logging.FileHandler(log_path)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+
+    return logger
+
+
+def install_slow_query_log(engine: object, threshold_ms: float,
+                           log_path: str=None,
+                           get_route: object=None) -> None:
+    """Log statements executed by `engine` that take at least
+    `threshold_ms`.
+
+    Args:
+        engine: Engine whose statements are timed
+        threshold_ms: Threshold in milliseconds
+        log_path: File the log is appended to, stderr if `None`
+        get_route: Called without arguments to return the route that issued
+            the statement, or `None` outside of requests
+    """
+    logger = create_logger(log_path)
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_timer(conn, cursor, statement, parameters, context,
+                    executemany):
+        conn.info.setdefault("slow_query_started", []).append(
+            time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def log_slow_query(conn, cursor, statement, parameters, context,
+                       executemany):
+        elapsed = time.perf_counter() - conn.info["slow_query_started"].pop()
+        if elapsed * 1000 < threshold_ms:
+            return
+
+        # Explain the first row of an executemany
+        if executemany and parameters:
+            parameters = parameters[0]
+
+        logger.warning(json.dumps({
+            "logged_at": datetime.utcnow().isoformat() + "Z",
+            "ms": round(elapsed * 1000, 3),
+            "route": get_route() if get_route is not None else None,
+            "executemany": executemany,
+            "statement": statement,
+            "parameters": parameters,
+            "plan": explain_query_plan(conn, statement, parameters),
+        }, default=str))
+
+
+def summarize(log_file: object) -> list:
+    """Group entries of a slow-query log by fingerprint.
+
+    Returns:
+        List of dictionaries with keys `fingerprint`, `count`, `total_ms`,
+        `max_ms`, `routes` and `plan` of the slowest entry.
+    """
+    groups = {}
+
+    for line in log_file:
+        line = line.strip()
+        if not line:
+            continue
+
+        entry = json.loads(line)
+        fingerprint = create_fingerprint(entry["statement"])
+        group = groups.setdefault(fingerprint, {
+            "fingerprint": fingerprint, "count": 0, "total_ms": 0.0,
+            "max_ms": 0.0, "routes": set(), "plan": None,
+        })
+        group["count"] += 1
+        group["total_ms"] += entry["ms"]
+        group["routes"].add(entry["route"] or "-")
+        if entry["ms"] >= group["max_ms"]:
+            group["max_ms"] = entry["ms"]
+            group["plan"] = entry["plan"]
+
+    return list(groups.values())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Summarize slow-query log by statement fingerprint.")
+    parser.add_argument("log", nargs="?", default=sys.path[0] +
+                        "/slow_queries.log", help="slow-query log file")
+    parser.add_argument("--sort", choices=["total_ms", "count", "max_ms"],
+                        default="total_ms", help="order of fingerprints")
+    parser.add_argument("--top", type=int, default=20,
+                        help="number of fingerprints to show")
+    args = parser.parse_args()
+
+    with open(args.log, "r") as log:
+        summary = summarize(log)
+    summary.sort(key=lambda g: g[args.sort], reverse=True)
+
+    for group in summary[:args.top]:
+        print("{:>6}x  total {:>10.1f} ms  mean {:>8.1f} ms  max {:>8.1f} "
+              "ms  routes: {}".format(
+                  group["count"], group["total_ms"],
+                  group["total_ms"] / group["count"], group["max_ms"],
+                  ", ".join(sorted(group["routes"]))))
+        print("    " + group["fingerprint"])
+        for step in group["plan"] or []:
+            print("      " + step)
+        print()
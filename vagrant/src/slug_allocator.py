@@ -0,0 +1,142 @@
+"""Allocate unique slugs for books and topics without scanning all rows.
+
+`helper.get_slug` needs the list of all existing slugs, which means loading
+every book or topic for each new slug. `SlugAllocator` keeps a counter per
+slugified text in table `slug_counter` instead. Allocating a slug increments
+the counter and checks the resulting candidate with a single lookup on the
+slug column, so the cost does not depend on the size of the catalog.
+
+Counters are incremented with an `UPDATE` inside the caller's transaction,
+which locks the row until the transaction ends, so two requests cannot be
+handed the same candidate. A missing counter is created with an `INSERT`
+that skips existing rows. If a concurrent request created the counter
+first, nothing is inserted and the counter is incremented instead of
+failing on the primary key. The unique index on the slug columns is the
+last line of defense.
+"""
+from sqlalchemy import and_, bindparam, exists, literal, or_, select
+from sqlalchemy.orm import Session
+
+from helper import create_slug
+from db_bookshelf import SlugCounter
+
+# Maximum number of ids per `IN` clause, SQLite allows 999 variables
+CHUNK_SIZE = 500
+
+
+class SlugAllocator:
+    """Allocate unique slugs for the `slug` column of `model`.
+
+    Example:
+        Existing books are "Learning Python", and "Learning Python Data Vis".
+        New book is titled "Learning Python" too. The counter for
+        "learning-python" is missing, so it is initialised from the existing
+        slugs `learning-python` and `learning-python-data-vis`. The new book
+        gets `learning-python-1` and the counter is set to 2.
+    """
+
+    def __init__(self, model: object):
+        self.model = model
+        self.kind = model.__tablename__
+
+    def allocate(self, session: Session, text: str="") -> str:
+        """Return a slug for `text` that is unique among all `model` rows.
+
+        Args:
+            session: Session whose transaction will insert the new row
+            text: Text that will be slugified with `helper.create_slug`
+        """
+        base = create_slug(text)
+
+        while True:
+            count = self.next_count(session, base)
+            slug = base if count == 0 else "{}-{}".format(base, count)
+
+            # Candidate can still be taken by a title that ends in a number,
+            # e.g. "Learning Python 3" vs. third "Learning Python"
+            if session.query(self.model.id).filter(
+                    self.model.slug == slug).first() is None:
+                return slug
+
+    def next_count(self, session: Session, base: str) -> int:
+        """Return next suffix for `base` and increment its counter."""
+        counters = SlugCounter.__table__
+        where = and_(counters.c.kind == self.kind, counters.c.base == base)
+
+        while True:
+            updated = session.execute(
+                counters.update().where(where)
+                .values(count=counters.c.count + 1)
+            )
+            if updated.rowcount:
+                return session.execute(
+                    select([counters.c.count]).where(where)
+                ).scalar() - 1
+
+            # No counter yet, e.g. slugs created before `slug_counter`
+            count = self.first_free_count(session, base)
+            inserted = session.execute(
+                counters.insert().from_select(
+                    ["kind", "base", "count"],
+                    select([literal(self.kind), literal(base),
+                            literal(count + 1)])
+                    .where(~exists().where(where))
+                )
+            )
+            if inserted.rowcount:
+                return count
+
+    def seed(self, bind: object, counts: dict) -> None:
+        """Raise counters to at least `counts`, e.g. after slugs were
+        assigned without the allocator. Missing counters are created.
+
+        Args:
+            bind: Session or connection of the transaction that added slugs
+            counts: Next suffix by slugified text
+        """
+        counters = SlugCounter.__table__
+        bases = list(counts)
+        existing = {}
+        for i in range(0, len(bases), CHUNK_SIZE):
+            existing.update(bind.execute(
+                select([counters.c.base, counters.c.count])
+                .where(and_(counters.c.kind == self.kind,
+                            counters.c.base.in_(bases[i:i + CHUNK_SIZE])))
+            ).fetchall())
+
+        updates = [dict(b=base, c=count) for base, count in counts.items()
+                   if base in existing and existing[base] < count]
+        inserts = [dict(kind=self.kind, base=base, count=count)
+                   for base, count in counts.items() if base not in existing]
+
+        if updates:
+            bind.execute(
+                counters.update()
+                .where(and_(counters.c.kind == self.kind,
+                            counters.c.base == bindparam("b")))
+                .values(count=bindparam("c")),
+                updates
+            )
+        if inserts:
+            bind.execute(counters.insert(), inserts)
+
+    def first_free_count(self, session: Session, base: str) -> int:
+        """Return suffix after the highest suffix already used for `base`.
+
+        Only slugs between "`base`-" and "`base`." can carry a suffix, which
+        is a range scan on the slug index rather than a table scan.
+        """
+        slugs = session.query(self.model.slug).filter(or_(
+            self.model.slug == base,
+            and_(self.model.slug > base + "-", self.model.slug < base + ".")
+        ))
+
+        count = -1
+        for slug, in slugs:
+            suffix = slug[len(base) + 1:]
+            if slug == base:
+                count = max(count, 0)
+            elif suffix.isdigit():
+                count = max(count, int(suffix))
+
+        return count + 1
@@ -0,0 +1,349 @@
+"""Compact in-memory copy of the catalog for read routes.
+
+`CatalogSnapshot` holds all books, topics and author names of one catalog
+version in `__slots__` records and keeps books ordered by publication date
+in arrays of integer keys, overall and per topic. Pages, book details and
+JSON exports are answered from it without any query. Related books are read
+from `related_book` once per book and snapshot.
+
+`SnapshotHolder` keeps the snapshot of the newest catalog version seen. On
+a new version, only books listed in `catalog_change` since the snapshot's
+version are reloaded, see `cache.bump_catalog_version`. Topics are few and
+reloaded completely. A new snapshot is built next to the old one and swapped
+in, so readers never see a half-applied change.
+"""
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+
+from sqlalchemy import select
+
+from db_bookshelf import (
+    Author, Book, BookAuthor, BookTopic, CatalogChange, Topic
+)
+from related_books import RelatedLink, select_related_ids
+
+# Maximum number of ids per `IN` clause, SQLite allows 999 variables
+CHUNK_SIZE = 500
+
+# Reload everything if more than this share of books changed at once
+MAX_CHANGED_SHARE = 0.25
+
+# Books are ordered by `pub_date` and `id`, combined in one integer key
+ID_BITS = 32
+ID_MASK = (1 << ID_BITS) - 1
+
+# Rows of pages, like the rows of the overview queries in `app.py`
+BookLink = namedtuple("BookLink", ["title", "slug", "topic_slug", "pub_date",
+                                   "id"])
+
+
+class BookRecord:
+    """Columns of one book and ids of its topics and authors in order."""
+    __slots__ = ("id", "title", "slug", "isbn", "description", "pub_date",
+                 "owner_id", "topic_ids", "author_ids")
+
+    def __init__(self, row: tuple):
+        (self.id, self.title, self.slug, self.isbn, self.description,
+         self.pub_date, self.owner_id) = row
+        self.topic_ids = ()
+        self.author_ids = ()
+
+    @property
+    def key(self) -> int:
+        """Sort key of the book, see `create_key`."""
+        return create_key(self.pub_date, self.id)
+
+
+class TopicRecord:
+    """Columns of one topic."""
+    __slots__ = ("id", "name", "slug", "owner_id")
+
+    def __init__(self, row: tuple):
+        self.id, self.name, self.slug, self.owner_id = row
+
+
+def create_key(pub_date: object, book_id: int) -> int:
+    """Return integer that sorts like tuple `(pub_date, book_id)`."""
+    return (pub_date.toordinal() << ID_BITS) | book_id
+
+
+def chunks(ids: list) -> list:
+    """Return `ids` in lists of at most `CHUNK_SIZE`."""
+    ids = list(ids)
+    return [ids[i:i + CHUNK_SIZE] for i in range(0, len(ids), CHUNK_SIZE)]
+
+
+def load_topics(bind: object) -> dict:
+    """Return dict of id -> `TopicRecord` of all topics."""
+    return dict((r[0], TopicRecord(r)) for r in bind.execute(
+        select([Topic.id, Topic.name, Topic.slug, Topic.owner_id])
+        .order_by(Topic.id)
+    ))
+
+
+def load_books(bind: object, book_ids: list=None) -> tuple:
+    """Return tuple `(books, author_names)` for `book_ids` or all books.
+
+    `books` is a dict of id -> `BookRecord` with topic and author ids,
+    `author_names` a dict of id -> name of their authors.
+    """
+    book_columns = [Book.id, Book.title, Book.slug, Book.isbn,
+                    Book.description, Book.pub_date, Book.owner_id]
+    topics = select([BookTopic.book_id, BookTopic.topic_id])
+    authors = select([BookAuthor.book_id, BookAuthor.author_id])
+    queries = [(select(book_columns), topics, authors)]
+
+    if book_ids is not None:
+        queries = [(select(book_columns).where(Book.id.in_(c)),
+                    topics.where(BookTopic.book_id.in_(c)),
+                    authors.where(BookAuthor.book_id.in_(c)))
+                   for c in chunks(book_ids)]
+
+    books = {}
+    topic_ids = {}
+    author_ids = {}
+    for book_query, topic_query, author_query in queries:
+        for row in bind.execute(book_query):
+            books[row[0]] = BookRecord(row)
+        for book_id, topic_id in bind.execute(topic_query):
+            topic_ids.setdefault(book_id, []).append(topic_id)
+        for book_id, author_id in bind.execute(author_query):
+            author_ids.setdefault(book_id, []).append(author_id)
+
+    for book_id, book in books.items():
+        book.topic_ids = tuple(sorted(topic_ids.get(book_id, ())))
+        book.author_ids = tuple(sorted(author_ids.get(book_id, ())))
+
+    names = {}
+    all_ids = set(i for ids in author_ids.values() for i in ids)
+    author_query = select([Author.id, Author.name])
+    author_queries = [author_query] if book_ids is None else \
+        [author_query.where(Author.id.in_(c)) for c in chunks(all_ids)]
+    for query in author_queries:
+        names.update((i, n) for i, n in bind.execute(query))
+
+    return books, names
+
+
+class CatalogSnapshot:
+    """All books, topics and author names of one catalog version.
+
+    Snapshots are never changed after they were built. `refresh` returns a
+    new snapshot that shares unchanged records with this one.
+    """
+
+    def __init__(self, version: int, books: dict, topics: dict,
+                 author_names: dict, order: array=None,
+                 topic_orders: dict=None):
+        self.version = version
+        self.books = books
+        self.topics = topics
+        self.author_names = author_names
+        self.book_ids_by_slug = dict((b.slug, b.id) for b in books.values())
+        self.topic_ids_by_slug = dict((t.slug, t.id) for t in topics.values())
+
+        if order is None:
+            order = array("q", sorted(b.key for b in books.values()))
+            topic_keys = {}
+            for book in books.values():
+                for topic_id in book.topic_ids:
+                    topic_keys.setdefault(topic_id, []).append(book.key)
+            topic_orders = dict((t, array("q", sorted(keys)))
+                                for t, keys in topic_keys.items())
+
+        self.order = order
+        self.topic_orders = topic_orders
+
+        # Lists of related ids by book id, loaded on first use; any change
+        # may change lists of other books, so they start empty per version
+        self.related_ids = {}
+
+    @classmethod
+    def load(cls, bind: object, version: int) -> "CatalogSnapshot":
+        """Load snapshot of the whole catalog at `version`."""
+        books, author_names = load_books(bind)
+        return cls(version, books, load_topics(bind), author_names)
+
+    def refresh(self, bind: object, version: int) -> "CatalogSnapshot":
+        """Return snapshot at `version`, reloading only changed books."""
+        changes = CatalogChange.__table__
+        changed_ids = set(i for i, in bind.execute(
+            select([changes.c.book_id]).distinct()
+            .where(changes.c.version > self.version)
+        ))
+        if len(changed_ids) > MAX_CHANGED_SHARE * max(len(self.books), 1):
+            return CatalogSnapshot.load(bind, version)
+
+        loaded, names = load_books(bind, changed_ids)
+        books = dict(self.books)
+        author_names = dict(self.author_names)
+        author_names.update(names)
+        order = array("q", self.order)
+        topic_orders = dict(self.topic_orders)
+        copied = set()
+        old_author_ids = set()
+
+        def topic_order(topic_id: int) -> array:
+            """Return own copy of the order of `topic_id` to change."""
+            if topic_id not in copied:
+                copied.add(topic_id)
+                topic_orders[topic_id] = array(
+                    "q", topic_orders.get(topic_id, ()))
+            return topic_orders[topic_id]
+
+        for book_id in changed_ids:
+            old = books.pop(book_id, None)
+            if old is not None:
+                old_author_ids.update(old.author_ids)
+                del order[bisect_left(order, old.key)]
+                for topic_id in old.topic_ids:
+                    keys = topic_order(topic_id)
+                    del keys[bisect_left(keys, old.key)]
+
+            new = loaded.get(book_id)
+            if new is not None:
+                books[book_id] = new
+                order.insert(bisect_left(order, new.key), new.key)
+                for topic_id in new.topic_ids:
+                    keys = topic_order(topic_id)
+                    keys.insert(bisect_left(keys, new.key), new.key)
+
+        # Authors only referenced by the old records of changed books may
+        # have been deleted with them
+        maybe_deleted = old_author_ids - set(names)
+        kept = set()
+        for chunk in chunks(maybe_deleted):
+            kept.update(i for i, in bind.execute(
+                select([Author.id]).where(Author.id.in_(chunk))))
+        for author_id in maybe_deleted - kept:
+            del author_names[author_id]
+
+        topics = load_topics(bind)
+        for topic_id in list(topic_orders):
+            if topic_id not in topics or not topic_orders[topic_id]:
+                del topic_orders[topic_id]
+
+        return CatalogSnapshot(version, books, topics, author_names, order,
+                               topic_orders)
+
+    def select_page(self, topic_id: int=None, after: tuple=None,
+                    before: tuple=None, limit: int=20) -> list:
+        """Return up to `limit` rows of `BookLink`, like a query for
+        `app.paginate_books`.
+
+        Rows are newest first, or oldest first if `before` is given, and
+        start right after or before the cursor `(pub_date, id)`.
+        """
+        order = self.order if topic_id is None else \
+            self.topic_orders.get(topic_id, ())
+
+        if before:
+            start = bisect_right(order, create_key(*before))
+            keys = order[start:start + limit]
+        else:
+            end = len(order) if not after else \
+                bisect_left(order, create_key(*after))
+            keys = order[max(end - limit, 0):end][::-1]
+
+        rows = []
+        for key in keys:
+            book = self.books[key & ID_MASK]
+
+            # Link to the given or the canonical topic, as in `latest_book`
+            topic = self.topics.get(topic_id or min(book.topic_ids or [0]))
+            rows.append(BookLink(book.title, book.slug,
+                                 topic.slug if topic else None,
+                                 book.pub_date, book.id))
+        return rows
+
+    def get_book(self, slug: str) -> BookRecord:
+        """Return book by `slug` or `None`."""
+        book_id = self.book_ids_by_slug.get(slug)
+        return self.books[book_id] if book_id is not None else None
+
+    def get_topic(self, slug: str) -> TopicRecord:
+        """Return topic by `slug` or `None`."""
+        topic_id = self.topic_ids_by_slug.get(slug)
+        return self.topics[topic_id] if topic_id is not None else None
+
+    def get_author_names(self, book: BookRecord) -> list:
+        """Return author names of `book`."""
+        return [self.author_names[i] for i in book.author_ids]
+
+    def get_related_books(self, bind: object, book: BookRecord) -> list:
+        """Return list of `related_books.RelatedLink` of `book`, best first,
+        like `related_books.select_related_books`.
+        """
+        related_ids = self.related_ids.get(book.id)
+        if related_ids is None:
+            related_ids = select_related_ids(bind, book.id)
+            self.related_ids[book.id] = related_ids
+
+        links = []
+        for related_id, score in related_ids:
+            related = self.books.get(related_id)
+            if related is not None:
+                # Link to the canonical topic, as in `latest_book`
+                topic = self.topics.get(min(related.topic_ids or [0]))
+                links.append(RelatedLink(related.title, related.slug,
+                                         topic.slug if topic else None,
+                                         score))
+        return links
+
+    def serialize_books(self, topic_id: int=None):
+        """Yield all books or books of `topic_id` ordered by id, in the
+        shape of `Book.serialize`.
+        """
+        if topic_id is None:
+            book_ids = sorted(self.books)
+        else:
+            book_ids = sorted(k & ID_MASK for k in
+                              self.topic_orders.get(topic_id, ()))
+
+        for book_id in book_ids:
+            book = self.books[book_id]
+            yield {
+                "title": book.title,
+                "isbn": book.isbn,
+                "description": book.description,
+                "publication_date": book.pub_date.strftime("%B %Y"),
+                "authors": self.get_author_names(book),
+                "topics": [self.topics[i].name for i in book.topic_ids
+                           if i in self.topics],
+            }
+
+
+class SnapshotHolder:
+    """Thread-safe holder of the newest `CatalogSnapshot`.
+
+    Example:
+        snapshot = holder.get(session, version)
+        Loads or refreshes the snapshot only if it is older than `version`.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshot = None
+
+    def get(self, bind: object, version: int) -> CatalogSnapshot:
+        """Return snapshot at `version` or newer."""
+        snapshot = self.snapshot
+        if snapshot is not None and snapshot.version >= version:
+            return snapshot
+
+        with self.lock:
+            snapshot = self.snapshot
+            if snapshot is None:
+                snapshot = CatalogSnapshot.load(bind, version)
+            elif snapshot.version < version:
+                snapshot = snapshot.refresh(bind, version)
+            self.snapshot = snapshot
+
+        return snapshot
+
+    def clear(self) -> None:
+        """Drop the snapshot."""
+        with self.lock:
+            self.snapshot = None